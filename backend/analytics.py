@@ -0,0 +1,122 @@
+"""
+تجميعات مبيعات محسوبة مسبقاً (يومية، شهرية، حسب المنتج والفئة)
+"""
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# نفس الحالات التي تُحتسب كإيراد في لوحة التحكم
+REVENUE_STATUSES = {'confirmed', 'shipped', 'delivered'}
+
+
+def _empty_bucket() -> dict:
+    return {'orders': 0, 'revenue_orders': 0, 'revenue': 0.0, 'units': 0}
+
+
+class SalesRollups:
+    """
+    عدد الطلبات يُحتسب عند الإنشاء بتاريخ الطلب. الإيراد والوحدات والفئات
+    تُحتسب عند دخول الطلب حالة إيراد وتُطرح عند خروجه منها، لتطابق
+    total_revenue في /admin/dashboard/stats.
+    """
+
+    def __init__(self):
+        self._reset()
+        self.backfilled_at = None
+
+    def _reset(self):
+        self.daily = {}          # 'YYYY-MM-DD' -> bucket
+        self.monthly = {}        # 'YYYY-MM' -> bucket
+        self.products = {}       # product_id -> {'name', 'units', 'revenue'}
+        self.categories = {}     # category -> {'units', 'revenue'}
+
+    def _buckets(self, created_at):
+        day = str(created_at or datetime.utcnow().isoformat())[:10]
+        daily = self.daily.setdefault(day, _empty_bucket())
+        monthly = self.monthly.setdefault(day[:7], _empty_bucket())
+        return daily, monthly
+
+    # ===== Incremental Updates =====
+    def record_order_created(self, order: dict, items: list = None):
+        """تسجيل طلب جديد"""
+        for bucket in self._buckets(order.get('created_at')):
+            bucket['orders'] += 1
+        if order.get('status') in REVENUE_STATUSES:
+            self._apply_revenue(order, items or [], 1)
+
+    def needs_items(self, previous_status: str, new_status: str) -> bool:
+        """هل يغيّر تغيير الحالة الإيراد (ويحتاج عناصر الطلب)؟"""
+        return (previous_status in REVENUE_STATUSES) != (new_status in REVENUE_STATUSES)
+
+    def record_status_change(self, order: dict, items: list, previous_status: str, new_status: str):
+        """تحديث الإيراد عند دخول/خروج الطلب من حالات الإيراد"""
+        if not self.needs_items(previous_status, new_status):
+            return
+        self._apply_revenue(order, items, 1 if new_status in REVENUE_STATUSES else -1)
+
+    def _apply_revenue(self, order: dict, items: list, sign: int):
+        units = sum(item.get('quantity', 0) for item in items)
+        for bucket in self._buckets(order.get('created_at')):
+            bucket['revenue_orders'] += sign
+            bucket['revenue'] += sign * (order.get('total_amount') or 0)
+            bucket['units'] += sign * units
+
+        for item in items:
+            product = item.get('products') or item.get('product') or {}
+            stats = self.products.setdefault(item['product_id'], {'name': None, 'units': 0, 'revenue': 0.0})
+            stats['name'] = product.get('name') or stats['name']
+            stats['units'] += sign * item.get('quantity', 0)
+            stats['revenue'] += sign * (item.get('total_price') or 0)
+
+            category = product.get('category') or 'uncategorized'
+            cat = self.categories.setdefault(category, {'units': 0, 'revenue': 0.0})
+            cat['units'] += sign * item.get('quantity', 0)
+            cat['revenue'] += sign * (item.get('total_price') or 0)
+
+    # ===== Backfill =====
+    def backfill(self, orders: list, order_items: list):
+        """إعادة بناء كل التجميعات من السجل الكامل"""
+        items_by_order = {}
+        for item in order_items:
+            items_by_order.setdefault(item['order_id'], []).append(item)
+
+        self._reset()
+        for order in orders:
+            self.record_order_created(order, items_by_order.get(order['id'], []))
+        self.backfilled_at = datetime.utcnow()
+        logger.info("Analytics backfilled from %s orders and %s items", len(orders), len(order_items))
+
+    # ===== Reads =====
+    def daily_series(self, days: int) -> list:
+        today = datetime.utcnow().date()
+        series = []
+        for offset in range(days - 1, -1, -1):
+            day = (today - timedelta(days=offset)).isoformat()
+            series.append({'period': day, **self.daily.get(day, _empty_bucket())})
+        return series
+
+    def monthly_series(self, months: int) -> list:
+        year, month = datetime.utcnow().year, datetime.utcnow().month
+        periods = []
+        for _ in range(months):
+            periods.append(f"{year:04d}-{month:02d}")
+            month -= 1
+            if month == 0:
+                year, month = year - 1, 12
+        return [{'period': p, **self.monthly.get(p, _empty_bucket())} for p in reversed(periods)]
+
+    def top_products(self, limit: int, by: str = 'units') -> list:
+        top = heapq.nlargest(limit, self.products.items(), key=lambda kv: kv[1][by])
+        return [{'product_id': pid, **stats} for pid, stats in top if stats[by] > 0]
+
+    def category_breakdown(self) -> list:
+        return sorted(
+            ({'category': name, **stats} for name, stats in self.categories.items()),
+            key=lambda c: c['revenue'], reverse=True
+        )
+
+
+# إنشاء instance مشترك
+rollups = SalesRollups()
@@ -16,6 +16,9 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "change-this-in-production")
 ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+# token قصير خاص بالبث (EventSource يمرره في الـ query فيظهر في السجلات)
+STREAM_TOKEN_EXPIRE_SECONDS = int(os.getenv("STREAM_TOKEN_EXPIRE_SECONDS", "60"))
+STREAM_TOKEN_SCOPE = "events"
 
 # إعداد الادمن عبر env vars
 ADMIN_DEFAULT_PASSWORD = os.getenv("ADMIN_DEFAULT_PASSWORD")
@@ -28,6 +31,7 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/admin/login")
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="/admin/login", auto_error=False)
 
 # إعداد اللوقر
 logger = logging.getLogger(__name__)
@@ -57,7 +61,7 @@ async def get_admin_by_email(email: str):
         admin = await db.get_admin_by_email(email)
         return admin
     except Exception as e:
-        logger.error(f"Error fetching admin: {e}")
+        logger.error("Error fetching admin: %s", e)
         return None
 
 async def authenticate_user(email: str, password: str):
@@ -69,8 +73,15 @@ async def authenticate_user(email: str, password: str):
         return False
     return admin
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    """جلب المستخدم الحالي من JWT token"""
+def create_stream_token(email: str):
+    """إنشاء token قصير العمر لا يصلح إلا لفتح اتصال البث"""
+    return create_access_token(
+        data={"sub": email, "scope": STREAM_TOKEN_SCOPE},
+        expires_delta=timedelta(seconds=STREAM_TOKEN_EXPIRE_SECONDS)
+    )
+
+async def _user_from_token(token: str, scope: Optional[str] = None):
+    """فك الـ token والتحقق من نطاقه ثم جلب الادمن"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -79,7 +90,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
-        if email is None:
+        if email is None or payload.get("scope") != scope:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
@@ -89,12 +100,28 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         raise credentials_exception
     return admin
 
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    """جلب المستخدم الحالي من JWT token (tokens البث مرفوضة هنا)"""
+    return await _user_from_token(token)
+
 async def get_current_active_user(current_user: dict = Depends(get_current_user)):
     """جلب المستخدم النشط الحالي"""
     if not current_user.get("is_active", True):
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
+async def get_stream_user(token: Optional[str] = None, bearer: Optional[str] = Depends(oauth2_scheme_optional)):
+    """جلب الادمن لاتصالات البث: token الدخول في الهيدر، أو token البث القصير في الـ query (EventSource لا يرسل هيدرز)"""
+    if bearer:
+        return await get_current_active_user(await get_current_user(bearer))
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await get_current_active_user(await _user_from_token(token, scope=STREAM_TOKEN_SCOPE))
+
 async def setup_default_admin():
     """إنشاء حساب الادمن الافتراضي"""
     try:
@@ -109,7 +136,7 @@ async def setup_default_admin():
                 if updated:
                     logger.info("Admin password reset from environment variable")
             except Exception as e:
-                logger.error(f"Failed resetting admin password: {e}")
+                logger.error("Failed resetting admin password: %s", e)
             return
         
         # إنشاء كلمة مرور مشفرة من البيئة
@@ -126,8 +153,8 @@ async def setup_default_admin():
         # إنشاء الادمن في قاعدة البيانات
         new_admin = await db.create_admin(admin_data)
         if new_admin:
-            logger.info(f"Default admin created: {ADMIN_EMAIL}")
+            logger.info("Default admin created: %s", ADMIN_EMAIL)
         else:
             logger.error("Failed to create default admin")
     except Exception as e:
-        logger.error(f"Error setting up default admin: {e}")
\ No newline at end of file
+        logger.error("Error setting up default admin: %s", e)
\ No newline at end of file
@@ -0,0 +1,86 @@
+"""
+ضغط استجابات JSON (brotli أو gzip) فوق حد أدنى للحجم
+"""
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:  # brotli اختياري، gzip متاح دائماً
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "4"))
+
+
+def choose_encoding(accept_encoding: str):
+    accepted = {part.split(';')[0].strip().lower() for part in accept_encoding.split(',')}
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+class JSONCompressionMiddleware:
+    """
+    Middleware ASGI يضغط استجابات application/json فقط. باقي الأنواع
+    (مثل text/event-stream والملفات) تمر كما هي بدون تخزين مؤقت.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get("headers", [])}
+        encoding = choose_encoding(headers.get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        body_parts = []
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                response_headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+                                    for k, v in message.get("headers", [])}
+                content_type = response_headers.get('content-type', '')
+                if not content_type.startswith('application/json') or 'content-encoding' in response_headers:
+                    passthrough = True
+                    await send(message)
+                else:
+                    start_message = message
+                return
+
+            if passthrough:
+                await send(message)
+                return
+
+            body_parts.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(body_parts)
+            response_headers = [(k, v) for k, v in start_message.get("headers", [])
+                                if k.lower() != b"content-length"]
+            if len(body) >= self.minimum_size:
+                if encoding == 'br':
+                    body = brotli.compress(body, quality=BROTLI_QUALITY)
+                else:
+                    body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+                response_headers.append((b"content-encoding", encoding.encode('latin-1')))
+                response_headers.append((b"vary", b"Accept-Encoding"))
+            response_headers.append((b"content-length", str(len(body)).encode('latin-1')))
+            await send({**start_message, "headers": response_headers})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
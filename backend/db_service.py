@@ -1,7 +1,13 @@
 from supabase import create_client, Client
+import asyncio
 import logging
 import os
 from dotenv import load_dotenv
+import time
+from collections import OrderedDict
+from metrics import timed_query
+from logging_config import setup_logging
+from resilience import ResilientExecutor, mark_stale, STALE_MAX_AGE_SECONDS
 
 # تحميل المتغيرات البيئية
 load_dotenv()
@@ -11,6 +17,13 @@ SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY", "")
 
+# حجم الدفعة في عمليات الإدراج/التحديث الجماعية
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+# أقصى عدد نتائج last-known-good محفوظة (الأقدم استخداماً يُحذف أولاً)
+STALE_MAX_ENTRIES = max(1, int(os.getenv("STALE_MAX_ENTRIES", "32")))
+# القائمة الكاملة لا تُحذف: هي الاحتياط لكل قراءات المنتجات الأخرى
+FULL_CATALOG_KEY = ('get_all_products', '*')
+
 if not SUPABASE_URL or not SUPABASE_ANON_KEY:
     raise RuntimeError("Supabase configuration is missing. Please set SUPABASE_URL and SUPABASE_ANON_KEY.")
 
@@ -19,151 +32,326 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
 supabase_admin: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY or SUPABASE_ANON_KEY)
 
 # إعداد اللوقر
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 class DatabaseService:
     def __init__(self):
         self.client = supabase
         self.admin_client = supabase_admin
+        self._inflight = {}
+        self._coalescing_stats = {}
+        self._last_good = OrderedDict()  # (method, key) -> (data, fetched_at)
+        self.executor = ResilientExecutor()
+
+    async def _execute(self, fn, retry: bool = False):
+        """تنفيذ استدعاء Supabase عبر المهلة وقاطع الدائرة (retry للقراءات فقط)"""
+        return await self.executor.run(fn, retry=retry)
+
+    # ===== Single-flight =====
+    async def _single_flight(self, method: str, key, query, stale_ok: bool = False, remember: bool = True):
+        """تنفيذ استعلام قراءة مرة واحدة لكل المستدعين المتزامنين بنفس المفتاح
+
+        الاستعلام يعمل في thread حتى لا يحجب event loop، والمستدعون اللاحقون
+        ينتظرون نفس الـ task. إلغاء أحد المستدعين لا يلغي الاستعلام المشترك.
+        مع stale_ok تُعاد آخر نتيجة ناجحة عند فشل الاستعلام أو فتح القاطع، وتُحفظ
+        النتائج غير الفارغة فقط (remember=False للاعتماد على القائمة الكاملة وحدها).
+        """
+        stats = self._coalescing_stats.setdefault(method, {'calls': 0, 'queries': 0, 'coalesced': 0})
+        stats['calls'] += 1
+        flight_key = (method, key)
+        task = self._inflight.get(flight_key)
+        if task is None:
+            stats['queries'] += 1
+            task = asyncio.ensure_future(self._execute(lambda: query().execute(), retry=True))
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(flight_key, None))
+        else:
+            stats['coalesced'] += 1
+        try:
+            data = (await asyncio.shield(task)).data
+        except Exception:
+            if stale_ok:
+                stale = self._stale_lookup(method, key)
+                if stale is not None:
+                    return stale
+            raise
+        if stale_ok and remember and data:
+            self._last_good[flight_key] = (data, time.monotonic())
+            self._last_good.move_to_end(flight_key)
+            while len(self._last_good) > STALE_MAX_ENTRIES:
+                oldest = next(k for k in self._last_good if k != FULL_CATALOG_KEY)
+                del self._last_good[oldest]
+        return data
+
+    def _stale_lookup(self, method: str, key):
+        """آخر نتيجة ناجحة لم تتجاوز STALE_MAX_AGE_SECONDS"""
+        entry = self._last_good.get((method, key))
+        if entry is None and method == 'get_all_products':
+            # القائمة الكاملة تحتوي كل الأعمدة المطلوبة
+            entry = self._last_good.get(FULL_CATALOG_KEY)
+        if entry is None and method == 'get_product_by_id':
+            # منتج واحد يمكن استخراجه من آخر قائمة كاملة
+            catalog = self._last_good.get(FULL_CATALOG_KEY)
+            if catalog is not None:
+                rows, fetched_at = catalog
+                # منتج غير موجود في القائمة القديمة: يُرفع الخطأ الأصلي بدل 404 مؤكد
+                matches = [row for row in rows if row.get('id') == key]
+                entry = (matches, fetched_at) if matches else None
+        if entry is None:
+            return None
+        data, fetched_at = entry
+        age = time.monotonic() - fetched_at
+        if age > STALE_MAX_AGE_SECONDS:
+            return None
+        logger.warning("Serving stale %s (%ss old)", method, int(age))
+        mark_stale(age)
+        return data
+
+    def get_resilience_stats(self):
+        """حالة قاطع الدائرة والمهل وإعادة المحاولة"""
+        return dict(self.executor.stats(), stale_entries=len(self._last_good))
+
+    def get_coalescing_stats(self):
+        """إحصائيات دمج الاستعلامات لكل دالة"""
+        return {method: dict(stats, inflight=sum(1 for m, _ in self._inflight if m == method))
+                for method, stats in self._coalescing_stats.items()}
 
     # ===== Products Operations =====
-    async def get_all_products(self):
-        """جلب جميع المنتجات"""
+    @timed_query
+    async def get_all_products(self, columns: str = '*'):
+        """جلب جميع المنتجات (columns لتحديد الأعمدة المطلوبة فقط)"""
         try:
-            response = self.client.table('products').select('*').execute()
-            return response.data
+            return await self._single_flight(
+                'get_all_products', columns,
+                lambda: self.client.table('products').select(columns),
+                stale_ok=True
+            )
         except Exception as e:
-            logger.error(f"Error fetching products: {e}")
+            logger.error("Error fetching products: %s", e)
             raise
 
+    @timed_query
     async def get_product_by_id(self, product_id: int):
         """جلب منتج بالمعرف"""
         try:
-            response = self.client.table('products').select('*').eq('id', product_id).execute()
-            if response.data:
-                return response.data[0]
+            data = await self._single_flight(
+                'get_product_by_id', product_id,
+                lambda: self.client.table('products').select('*').eq('id', product_id),
+                stale_ok=True, remember=False
+            )
+            if data:
+                return data[0]
             return None
         except Exception as e:
-            logger.error(f"Error fetching product {product_id}: {e}")
+            logger.error("Error fetching product %s: %s", product_id, e)
+            raise
+
+    @timed_query
+    async def get_media_references(self, page_size: int = 1000):
+        """روابط صور كل المنتجات عبر admin_client (بدون RLS) وبصفحات حتى لا يقطع max-rows النتيجة"""
+        try:
+            rows = []
+            while True:
+                start = len(rows)
+                response = await self._execute(
+                    lambda: self.admin_client.table('products').select('id,image_url,images')
+                    .order('id').range(start, start + page_size - 1).execute(),
+                    retry=True
+                )
+                rows.extend(response.data)
+                if len(response.data) < page_size:
+                    return rows
+        except Exception as e:
+            logger.error("Error fetching media references: %s", e)
+            raise
+
+    @timed_query
+    async def get_products_by_ids(self, product_ids: list):
+        """جلب عدة منتجات باستعلام واحد"""
+        if not product_ids:
+            return []
+        try:
+            response = await self._execute(lambda: self.client.table('products').select('*').in_('id', list(product_ids)).execute(), retry=True)
+            return response.data
+        except Exception as e:
+            logger.error("Error fetching products %s: %s", product_ids, e)
             raise
 
+    @timed_query
     async def create_product(self, product_data: dict):
         """إنشاء منتج جديد"""
         try:
-            response = self.admin_client.table('products').insert(product_data).execute()
+            response = await self._execute(lambda: self.admin_client.table('products').insert(product_data).execute())
             return response.data[0] if response.data else None
         except Exception as e:
-            logger.error(f"Error creating product: {e}")
+            logger.error("Error creating product: %s", e)
             raise
 
+    @timed_query
     async def update_product(self, product_id: int, product_data: dict):
         """تحديث منتج"""
         try:
-            response = self.admin_client.table('products').update(product_data).eq('id', product_id).execute()
+            response = await self._execute(lambda: self.admin_client.table('products').update(product_data).eq('id', product_id).execute())
             return response.data[0] if response.data else None
         except Exception as e:
-            logger.error(f"Error updating product {product_id}: {e}")
+            logger.error("Error updating product %s: %s", product_id, e)
             raise
 
+    @timed_query
     async def delete_product(self, product_id: int):
         """حذف منتج"""
         try:
-            response = self.admin_client.table('products').delete().eq('id', product_id).execute()
+            response = await self._execute(lambda: self.admin_client.table('products').delete().eq('id', product_id).execute())
             return True
         except Exception as e:
-            logger.error(f"Error deleting product {product_id}: {e}")
+            logger.error("Error deleting product %s: %s", product_id, e)
             raise
 
+    @timed_query
+    async def bulk_upsert_products(self, products: list, chunk_size: int = BULK_CHUNK_SIZE):
+        """إنشاء وتحديث منتجات على دفعات متعددة الصفوف
+
+        الصفوف بدون id تُدرج، والصفوف التي تحمل id تُحدَّث (upsert) ويجب أن تكون
+        كاملة الأعمدة. يعيد قائمة بنفس ترتيب المدخلات: الصف الناتج أو الاستثناء.
+        """
+        results = [None] * len(products)
+        inserts = [(i, p) for i, p in enumerate(products) if not p.get('id')]
+        upserts = [(i, p) for i, p in enumerate(products) if p.get('id')]
+
+        for group, is_insert in ((inserts, True), (upserts, False)):
+            for start in range(0, len(group), chunk_size):
+                chunk = group[start:start + chunk_size]
+                payload = [p for _, p in chunk]
+                try:
+                    table = self.admin_client.table('products')
+                    query = table.insert(payload) if is_insert else table.upsert(payload)
+                    returned = (await self._execute(query.execute)).data or []
+                    if is_insert:
+                        for (idx, _), row in zip(chunk, returned):
+                            results[idx] = row
+                    else:
+                        by_id = {row['id']: row for row in returned}
+                        for idx, p in chunk:
+                            results[idx] = by_id.get(p['id'])
+                except Exception as e:
+                    logger.error("Error in bulk product chunk (%s rows): %s", len(chunk), e)
+                    for idx, _ in chunk:
+                        results[idx] = e
+        return results
+
     # ===== Orders Operations =====
-    async def get_all_orders(self):
+    @timed_query
+    async def get_all_orders(self, columns: str = '*'):
         """جلب جميع الطلبات"""
         try:
-            response = self.admin_client.table('orders').select('*').order('created_at', desc=True).execute()
+            response = await self._execute(lambda: self.admin_client.table('orders').select(columns).order('created_at', desc=True).execute(), retry=True)
             return response.data
         except Exception as e:
-            logger.error(f"Error fetching orders: {e}")
+            logger.error("Error fetching orders: %s", e)
             raise
 
+    @timed_query
     async def get_order_by_id(self, order_id: int):
         """جلب طلب بالمعرف"""
         try:
-            response = self.admin_client.table('orders').select('*').eq('id', order_id).execute()
+            response = await self._execute(lambda: self.admin_client.table('orders').select('*').eq('id', order_id).execute(), retry=True)
             if response.data:
                 return response.data[0]
             return None
         except Exception as e:
-            logger.error(f"Error fetching order {order_id}: {e}")
+            logger.error("Error fetching order %s: %s", order_id, e)
             raise
 
+    @timed_query
     async def create_order(self, order_data: dict):
         """إنشاء طلب جديد"""
         try:
-            response = self.client.table('orders').insert(order_data).execute()
+            response = await self._execute(lambda: self.client.table('orders').insert(order_data).execute())
             return response.data[0] if response.data else None
         except Exception as e:
-            logger.error(f"Error creating order: {e}")
+            logger.error("Error creating order: %s", e)
             raise
 
+    @timed_query
     async def update_order_status(self, order_id: int, status: str):
         """تحديث حالة الطلب"""
         try:
-            response = self.admin_client.table('orders').update({'status': status}).eq('id', order_id).execute()
+            response = await self._execute(lambda: self.admin_client.table('orders').update({'status': status}).eq('id', order_id).execute())
             return response.data[0] if response.data else None
         except Exception as e:
-            logger.error(f"Error updating order status {order_id}: {e}")
+            logger.error("Error updating order status %s: %s", order_id, e)
             raise
 
     # ===== Order Items Operations =====
-    async def get_order_items(self, order_id: int):
-        """جلب عناصر الطلب"""
+    @timed_query
+    async def get_order_items(self, order_id: int, product_columns: str = '*'):
+        """جلب عناصر الطلب (product_columns لتحديد أعمدة المنتج المضمّن)"""
+        try:
+            return await self._single_flight(
+                'get_order_items', (order_id, product_columns),
+                lambda: self.client.table('order_items').select(f'''
+                    *,
+                    products:product_id ({product_columns})
+                ''').eq('order_id', order_id)
+            )
+        except Exception as e:
+            logger.error("Error fetching order items for order %s: %s", order_id, e)
+            raise
+
+    @timed_query
+    async def get_all_order_items(self):
+        """جلب جميع عناصر الطلبات مع اسم وفئة المنتج (للتجميعات)"""
         try:
-            response = self.client.table('order_items').select('''
-                *,
-                products:product_id (*)
-            ''').eq('order_id', order_id).execute()
+            response = await self._execute(lambda: self.admin_client.table('order_items').select(
+                'order_id, product_id, quantity, total_price, products:product_id (name, category)'
+            ).execute(), retry=True)
             return response.data
         except Exception as e:
-            logger.error(f"Error fetching order items for order {order_id}: {e}")
+            logger.error("Error fetching all order items: %s", e)
             raise
 
+    @timed_query
     async def create_order_items(self, order_items: list):
         """إنشاء عناصر الطلب"""
         try:
-            response = self.client.table('order_items').insert(order_items).execute()
+            response = await self._execute(lambda: self.client.table('order_items').insert(order_items).execute())
             return response.data
         except Exception as e:
-            logger.error(f"Error creating order items: {e}")
+            logger.error("Error creating order items: %s", e)
             raise
 
     # ===== Admin Operations =====
+    @timed_query
     async def get_admin_by_email(self, email: str):
         """جلب الادمن بالبريد الإلكتروني"""
         try:
-            response = self.admin_client.table('admins').select('*').eq('email', email).execute()
+            response = await self._execute(lambda: self.admin_client.table('admins').select('*').eq('email', email).execute(), retry=True)
             if response.data:
                 return response.data[0]
             return None
         except Exception as e:
-            logger.error(f"Error fetching admin by email {email}: {e}")
+            logger.error("Error fetching admin by email %s: %s", email, e)
             raise
 
+    @timed_query
     async def create_admin(self, admin_data: dict):
         """إنشاء حساب ادمن جديد"""
         try:
-            response = self.admin_client.table('admins').insert(admin_data).execute()
+            response = await self._execute(lambda: self.admin_client.table('admins').insert(admin_data).execute())
             return response.data[0] if response.data else None
         except Exception as e:
-            logger.error(f"Error creating admin: {e}")
+            logger.error("Error creating admin: %s", e)
             raise
 
+    @timed_query
     async def update_admin_password(self, email: str, new_password_hash: str):
         """تحديث كلمة مرور الادمن بواسطة البريد"""
         try:
-            response = self.admin_client.table('admins').update({'password_hash': new_password_hash}).eq('email', email).execute()
+            response = await self._execute(lambda: self.admin_client.table('admins').update({'password_hash': new_password_hash}).eq('email', email).execute())
             return response.data[0] if response.data else None
         except Exception as e:
-            logger.error(f"Error updating admin password for {email}: {e}")
+            logger.error("Error updating admin password for %s: %s", email, e)
             raise
 
 # إنشاء instance من DatabaseService
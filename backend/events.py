@@ -0,0 +1,82 @@
+"""
+وسيط أحداث داخلي (pub/sub) لبث الطلبات وتغييرات المخزون للوحة التحكم
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+from datetime import datetime
+
+# حجم صف كل مشترك: عند الامتلاء يُحذف أقدم حدث بدلاً من حجب الناشر
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "100"))
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", "15"))
+LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class EventBroker:
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._ids = itertools.count(1)
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self) -> asyncio.Queue:
+        """تسجيل مشترك جديد بصف محدود الحجم"""
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        logger.info("Event subscriber added (%s active)", len(self._subscribers))
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """إلغاء تسجيل مشترك"""
+        self._subscribers.discard(queue)
+        logger.info("Event subscriber removed (%s active)", len(self._subscribers))
+
+    def publish(self, event_type: str, data) -> dict:
+        """نشر حدث لجميع المشتركين دون انتظار"""
+        event = {
+            "id": next(self._ids),
+            "type": event_type,
+            "data": data,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        self.published += 1
+        for queue in list(self._subscribers):
+            if queue.full():
+                try:
+                    queue.get_nowait()
+                    self.dropped += 1
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait(event)
+        return event
+
+    def publish_stock(self, product: dict):
+        """نشر حدث low_stock إذا انخفض المخزون تحت الحد"""
+        if product and product.get('stock_quantity', 0) < LOW_STOCK_THRESHOLD:
+            self.publish("low_stock", {
+                "product_id": product.get('id'),
+                "name": product.get('name'),
+                "stock_quantity": product.get('stock_quantity', 0)
+            })
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+
+def format_sse(event: dict) -> str:
+    """تحويل حدث إلى صيغة Server-Sent Events"""
+    payload = json.dumps(event["data"], default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+
+# إنشاء instance مشترك
+broker = EventBroker()
@@ -0,0 +1,216 @@
+"""
+فهرس فلاتر الكتالوج: bitsets للفئات وشرائح السعر والتوفر والمخزون مع عدّادات لكل فلتر
+"""
+import logging
+import os
+from datetime import datetime
+
+# حدود شرائح السعر (آخر شريحة مفتوحة للأعلى)
+FACET_PRICE_EDGES = tuple(float(e) for e in os.getenv("FACET_PRICE_EDGES", "0,250,500,1000,2000").split(','))
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_bits(mask: int):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class FacetIndex:
+    """
+    كل منتج يأخذ slot ثابتاً، وكل قيمة فلتر تُمثَّل بعدد صحيح يعمل كـ bitset
+    على هذه الـ slots. دمج الفلاتر عمليات AND، والعدّ bit_count().
+    """
+
+    def __init__(self, price_edges=FACET_PRICE_EDGES):
+        self.price_edges = tuple(sorted(price_edges))
+        self._clear()
+        self.built_at = None
+
+    def _clear(self):
+        self._slots = {}          # product_id -> slot
+        self._rows = []           # slot -> row
+        self._free = []
+        self._categories = {}     # category -> mask
+        self._price = [0] * len(self.price_edges)
+        self._available = 0
+        self._in_stock = 0
+        self._all = 0
+
+    @property
+    def built(self) -> bool:
+        return self.built_at is not None
+
+    def _bucket(self, price) -> int:
+        bucket = 0
+        for i, edge in enumerate(self.price_edges):
+            if (price or 0) >= edge:
+                bucket = i
+        return bucket
+
+    # ===== Writes =====
+    def build(self, products: list):
+        self._clear()
+        for product in products:
+            self.upsert(product)
+        self.built_at = datetime.utcnow()
+        logger.info("Facet index built for %s products", len(products))
+
+    def upsert(self, product: dict):
+        """إضافة أو تحديث منتج (الصف الكامل من قاعدة البيانات)"""
+        pid = product.get('id')
+        if pid is None:
+            return
+        slot = self._slots.get(pid)
+        if slot is None:
+            slot = self._free.pop() if self._free else len(self._rows)
+            if slot == len(self._rows):
+                self._rows.append(None)
+            self._slots[pid] = slot
+        else:
+            self._unset(slot)
+
+        bit = 1 << slot
+        self._rows[slot] = dict(product)
+        self._all |= bit
+        category = product.get('category')
+        if category:
+            self._categories[category] = self._categories.get(category, 0) | bit
+        self._price[self._bucket(product.get('price'))] |= bit
+        if product.get('is_available', True):
+            self._available |= bit
+        if (product.get('stock_quantity') or 0) > 0:
+            self._in_stock |= bit
+
+    def set_stock(self, product_id: int, stock_quantity: int):
+        """تحديث bit المخزون فقط بعد الطلبات"""
+        slot = self._slots.get(product_id)
+        if slot is None:
+            return
+        self._rows[slot]['stock_quantity'] = stock_quantity
+        if stock_quantity > 0:
+            self._in_stock |= 1 << slot
+        else:
+            self._in_stock &= ~(1 << slot)
+
+    def remove(self, product_id: int):
+        slot = self._slots.pop(product_id, None)
+        if slot is None:
+            return
+        self._unset(slot)
+        self._rows[slot] = None
+        self._free.append(slot)
+
+    def _unset(self, slot: int):
+        mask = ~(1 << slot)
+        self._all &= mask
+        self._available &= mask
+        self._in_stock &= mask
+        self._price = [m & mask for m in self._price]
+        for category in list(self._categories):
+            self._categories[category] &= mask
+            if not self._categories[category]:
+                del self._categories[category]
+
+    # ===== Queries =====
+    def get(self, product_id: int):
+        """صف منتج واحد من الفهرس (أو None)"""
+        slot = self._slots.get(product_id)
+        return self._rows[slot] if slot is not None else None
+
+    def _flag_mask(self, flag_mask: int, wanted) -> int:
+        if wanted is None:
+            return self._all
+        return flag_mask if wanted else self._all & ~flag_mask
+
+    def _price_mask(self, min_price, max_price) -> int:
+        if min_price is None and max_price is None:
+            return self._all
+        low = min_price if min_price is not None else float('-inf')
+        high = max_price if max_price is not None else float('inf')
+        overlapping = []
+        for i in range(len(self.price_edges)):
+            # الشريحة الأولى تحتوي أيضاً الأسعار الأقل من أول حد
+            lower = self.price_edges[i] if i else float('-inf')
+            upper = self.price_edges[i + 1] if i + 1 < len(self.price_edges) else float('inf')
+            if lower <= high and upper > low:
+                overlapping.append((i, lower, upper))
+        mask = 0
+        for i, _, _ in overlapping:
+            mask |= self._price[i]
+        # الشرائح الداخلية داخل المدى بالكامل؛ فقط الطرفيتان قد تحتويان أسعاراً خارجه
+        for i, lower, upper in {overlapping[0], overlapping[-1]} if overlapping else ():
+            if lower >= low and upper <= high:
+                continue
+            for slot in _iter_bits(self._price[i]):
+                price = self._rows[slot].get('price') or 0
+                if price < low or price > high:
+                    mask &= ~(1 << slot)
+        return mask
+
+    def _search_mask(self, q) -> int:
+        if not q:
+            return self._all
+        q = q.lower()
+        mask = 0
+        for slot in _iter_bits(self._all):
+            row = self._rows[slot]
+            if (q in (row.get('name') or '').lower() or q in (row.get('description') or '').lower()
+                    or q in (row.get('category') or '').lower()):
+                mask |= 1 << slot
+        return mask
+
+    def query(self, category=None, min_price=None, max_price=None, available=None, in_stock=None, q=None):
+        """النتائج مرتبة بالمعرف + عدّادات كل فلتر محسوبة مع باقي الفلاتر فقط"""
+        cat_mask = self._categories.get(category, 0) if category else self._all
+        if category and not cat_mask:
+            # مطابقة بدون حساسية لحالة الأحرف مثل /products
+            for name, mask in self._categories.items():
+                if name.lower() == category.lower():
+                    cat_mask |= mask
+        price_mask = self._price_mask(min_price, max_price)
+        avail_mask = self._flag_mask(self._available, available)
+        stock_mask = self._flag_mask(self._in_stock, in_stock)
+        text_mask = self._search_mask(q)
+
+        result = cat_mask & price_mask & avail_mask & stock_mask & text_mask
+        rows = sorted((self._rows[slot] for slot in _iter_bits(result)), key=lambda r: r['id'])
+
+        base_for_categories = price_mask & avail_mask & stock_mask & text_mask
+        base_for_price = cat_mask & avail_mask & stock_mask & text_mask
+        base_for_available = cat_mask & price_mask & stock_mask & text_mask
+        base_for_stock = cat_mask & price_mask & avail_mask & text_mask
+
+        price_facets = []
+        for i, edge in enumerate(self.price_edges):
+            upper = self.price_edges[i + 1] if i + 1 < len(self.price_edges) else None
+            price_facets.append({'min': edge, 'max': upper,
+                                 'count': (self._price[i] & base_for_price).bit_count()})
+
+        facets = {
+            'categories': {name: (mask & base_for_categories).bit_count()
+                           for name, mask in sorted(self._categories.items())},
+            'price': price_facets,
+            'availability': {
+                'available': (self._available & base_for_available).bit_count(),
+                'unavailable': (base_for_available & ~self._available).bit_count()
+            },
+            'stock': {
+                'in_stock': (self._in_stock & base_for_stock).bit_count(),
+                'out_of_stock': (base_for_stock & ~self._in_stock).bit_count()
+            }
+        }
+        return rows, facets
+
+    def stats(self) -> dict:
+        return {
+            "products": len(self._slots),
+            "categories": len(self._categories),
+            "built_at": self.built_at
+        }
+
+
+# إنشاء instance مشترك
+facet_index = FacetIndex()
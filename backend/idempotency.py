@@ -0,0 +1,152 @@
+"""
+مخزن Idempotency-Key لمنع تكرار الطلبات عند إعادة المحاولة
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+# مسار اختياري لحفظ المفاتيح بين إعادة التشغيل
+IDEMPOTENCY_STORE_PATH = os.getenv("IDEMPOTENCY_STORE_PATH", "")
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyConflict(Exception):
+    """نفس المفتاح استُخدم مع محتوى طلب مختلف"""
+
+
+def fingerprint(payload: dict) -> str:
+    """بصمة ثابتة لمحتوى الطلب"""
+    raw = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, max_keys: int = IDEMPOTENCY_MAX_KEYS, ttl: int = IDEMPOTENCY_TTL_SECONDS,
+                 path: Optional[str] = IDEMPOTENCY_STORE_PATH):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self._entries = OrderedDict()  # key -> {fingerprint, response, created_at}
+        self._inflight = {}  # key -> (fingerprint, future)
+        self.hits = 0
+        self.waits = 0
+        self._persist_task = None
+        self._persist_dirty = False
+        self._load()
+
+    def _load(self):
+        """تحميل المفاتيح المحفوظة إن وُجدت"""
+        if not self.path or not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding='utf-8'))
+            for key, entry in data.items():
+                self._entries[key] = entry
+            self._evict()
+            logger.info("Loaded %s idempotency keys", len(self._entries))
+        except Exception as e:
+            logger.error("Failed loading idempotency store: %s", e)
+
+    def _write(self, snapshot: dict):
+        """كتابة نسخة ثابتة من المفاتيح (في thread، كاتب واحد فقط في كل مرة)"""
+        try:
+            tmp = self.path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(snapshot, default=str), encoding='utf-8')
+            tmp.replace(self.path)
+        except Exception as e:
+            logger.error("Failed persisting idempotency store: %s", e)
+
+    async def _persist_loop(self):
+        while self._persist_dirty:
+            self._persist_dirty = False
+            # النسخة تُؤخذ على event loop حتى لا يتغير الـ OrderedDict أثناء التسلسل
+            await asyncio.to_thread(self._write, dict(self._entries))
+
+    async def _persist(self):
+        """جدولة حفظ؛ الطلبات المتزامنة تُدمج في كتابات متتالية من كاتب واحد"""
+        self._persist_dirty = True
+        if self._persist_task is None or self._persist_task.done():
+            self._persist_task = asyncio.ensure_future(self._persist_loop())
+        await asyncio.shield(self._persist_task)
+
+    def _evict(self):
+        """حذف المفاتيح المنتهية ثم الأقدم استخداماً عند تجاوز الحد"""
+        cutoff = time.time() - self.ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry['created_at'] >= cutoff and len(self._entries) <= self.max_keys:
+                break
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry and entry['created_at'] < time.time() - self.ttl:
+            del self._entries[key]
+            return None
+        return entry
+
+    async def run(self, key: str, request_fingerprint: str, func):
+        """تنفيذ func مرة واحدة لكل مفتاح. يعيد (الاستجابة, replayed)"""
+        entry = self._lookup(key)
+        if entry:
+            if entry['fingerprint'] != request_fingerprint:
+                raise IdempotencyConflict(key)
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry['response'], True
+
+        pending = self._inflight.get(key)
+        if pending:
+            pending_fingerprint, future = pending
+            if pending_fingerprint != request_fingerprint:
+                raise IdempotencyConflict(key)
+            self.waits += 1
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (request_fingerprint, future)
+        try:
+            response = await func()
+        except BaseException as e:
+            # الفشل لا يُخزَّن حتى تنجح إعادة المحاولة لاحقاً
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        self._entries[key] = {
+            'fingerprint': request_fingerprint,
+            'response': response,
+            'created_at': time.time()
+        }
+        self._evict()
+        # المنتظرون لا يعتمدون على الحفظ (ولا يعلقون إذا أُلغي الطلب أثناءه)
+        future.set_result(response)
+        if self.path:
+            await self._persist()
+        return response, False
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "waits": self.waits
+        }
+
+
+# إنشاء instance مشترك
+idempotency_store = IdempotencyStore()
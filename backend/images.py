@@ -0,0 +1,176 @@
+"""
+تصغير وتحويل صور المنتجات عند الطلب مع cache على القرص (LRU محدود الحجم)
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow مطلوب فقط لنقطة /img
+    Image = None
+
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", "image_cache"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+# العروض المسموحة فقط حتى لا يمكن ملء الـ cache بعروض عشوائية
+IMAGE_WIDTHS = tuple(sorted(int(w) for w in os.getenv("IMAGE_WIDTHS", "150,300,600,900,1200,1600").split(',')))
+IMAGE_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG', 'jpg': 'JPEG', 'png': 'PNG'}
+MEDIA_TYPES = {'WEBP': 'image/webp', 'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+logger = logging.getLogger(__name__)
+
+
+class ImageNotFound(Exception):
+    pass
+
+
+def snap_width(width: int) -> int:
+    """أقرب عرض مسموح لا يقل عن المطلوب"""
+    for allowed in IMAGE_WIDTHS:
+        if allowed >= width:
+            return allowed
+    return IMAGE_WIDTHS[-1]
+
+
+def _render(source: bytes, width: int, pil_format: str) -> bytes:
+    """تصغير الصورة مع الحفاظ على النسبة ثم ترميزها بالصيغة المطلوبة"""
+    with Image.open(io.BytesIO(source)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.width > width:
+            image.thumbnail((width, image.height), Image.LANCZOS)
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, format=pil_format, quality=IMAGE_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+class DiskLRUCache:
+    """ملفات على القرص مع فهرس LRU في الذاكرة وحد أقصى للحجم الكلي"""
+
+    def __init__(self, directory: Path = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._index = OrderedDict()  # name -> size
+        self.total_bytes = 0
+        self.evictions = 0
+        files = sorted((p for p in self.directory.iterdir() if p.is_file() and not p.name.endswith('.tmp')),
+                       key=lambda p: p.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._index[path.name] = size
+            self.total_bytes += size
+
+    def get(self, name: str):
+        if name not in self._index:
+            return None
+        path = self.directory / name
+        if not path.exists():
+            self.total_bytes -= self._index.pop(name)
+            return None
+        self._index.move_to_end(name)
+        return path
+
+    def write(self, name: str, data: bytes) -> Path:
+        """كتابة الملف فقط (آمنة للتشغيل في thread)"""
+        path = self.directory / name
+        tmp = path.with_name(name + '.tmp')
+        tmp.write_bytes(data)
+        tmp.replace(path)
+        return path
+
+    def add(self, name: str, data: bytes) -> Path:
+        """تسجيل ملف مكتوب في الفهرس ثم الحذف حسب LRU (من event loop)"""
+        path = self.directory / name
+        if name in self._index:
+            self.total_bytes -= self._index.pop(name)
+        self._index[name] = len(data)
+        self.total_bytes += len(data)
+        self._evict(keep=name)
+        return path
+
+    def _evict(self, keep: str):
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            name, size = next(iter(self._index.items()))
+            if name == keep:
+                break
+            self._index.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ImageResizer:
+    def __init__(self, cache: DiskLRUCache = None, workers: int = IMAGE_WORKERS):
+        self._cache = cache
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="img")
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @property
+    def available(self) -> bool:
+        return Image is not None
+
+    @property
+    def cache(self) -> DiskLRUCache:
+        # إنشاء مجلد الـ cache عند أول استخدام فقط
+        if self._cache is None:
+            self._cache = DiskLRUCache()
+        return self._cache
+
+    async def get_variant(self, filename: str, width: int, fmt: str, load_source):
+        """مسار النسخة المصغّرة ونوعها. load_source(filename) يعيد bytes الأصلية أو None"""
+        pil_format = IMAGE_FORMATS[fmt]
+        key = hashlib.sha1(f"{filename}:{width}:{pil_format}".encode('utf-8')).hexdigest()
+        name = f"{key}.{pil_format.lower()}"
+
+        path = self.cache.get(name)
+        if path is not None:
+            self.hits += 1
+            return path, MEDIA_TYPES[pil_format]
+
+        task = self._inflight.get(name)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._build(name, filename, width, pil_format, load_source))
+            self._inflight[name] = task
+            task.add_done_callback(lambda _: self._inflight.pop(name, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task), MEDIA_TYPES[pil_format]
+
+    async def _build(self, name: str, filename: str, width: int, pil_format: str, load_source):
+        source = await load_source(filename)
+        if source is None:
+            raise ImageNotFound(filename)
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(self._pool, _render, source, width, pil_format)
+        await asyncio.to_thread(self.cache.write, name, data)
+        return self.cache.add(name, data)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "cached_files": len(self.cache._index),
+            "cache_bytes": self.cache.total_bytes,
+            "evictions": self.cache.evictions
+        }
+
+
+# إنشاء instance مشترك
+image_resizer = ImageResizer()
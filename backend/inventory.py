@@ -0,0 +1,236 @@
+"""
+دفتر مخزون داخل العملية: حجز ذري للكميات مع كتابة مجمّعة للفروقات إلى جدول products
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+INVENTORY_RESERVATION_TTL = float(os.getenv("INVENTORY_RESERVATION_TTL", "300"))
+INVENTORY_FLUSH_INTERVAL = float(os.getenv("INVENTORY_FLUSH_INTERVAL", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id: int, available: int):
+        super().__init__(f"Insufficient stock for product {product_id}")
+        self.product_id = product_id
+        self.available = available
+
+
+class InventoryLedger:
+    """
+    العدادات تُهيّأ من قاعدة البيانات عند أول استخدام لكل منتج.
+    الحجز والتأكيد والتحرير عمليات متزامنة بدون await، لذلك كل عملية
+    تحقق-وخصم ذرية داخل حلقة asyncio ولا يمكن أن يحدث بيع زائد.
+    الفرق الصافي يُكتب دورياً بكتابة واحدة لكل منتج بدلاً من كتابة لكل طلب.
+    القيم الجديدة من قاعدة البيانات (تعديلات خارج العملية) تُدمج عند كل قراءة
+    للمنتجات ما لم تتداخل القراءة مع flush.
+    الخصومات المؤكدة تُسجَّل أيضاً كمهمة durable في outbox الطابور قبل الرد على الطلب
+    (settle يكتمل بعد كتابتها، و consume يعيدها إلى الذاكرة بعد إعادة التشغيل).
+    """
+
+    def __init__(self, database=None, ttl: float = INVENTORY_RESERVATION_TTL):
+        self._db = database
+        self.ttl = ttl
+        self.on_flush = None     # callback(product_ids) بعد كتابة المخزون
+        self._db_stock = {}      # product_id -> آخر قيمة مكتوبة في قاعدة البيانات
+        self._pending = {}       # product_id -> كمية مؤكدة لم تُكتب بعد
+        self._reserved = {}      # product_id -> كمية محجوزة حالياً
+        self._versions = {}      # product_id -> يزيد عند تعيين المخزون من الادمن
+        self._reservations = {}  # reservation_id -> (items, expires_at)
+        self._failed = set()     # منتجات فشلت آخر محاولة كتابة لها
+        self._flush_lock = asyncio.Lock()
+        self._epoch = 0          # يزيد عند بداية ونهاية كل flush
+        self.reconciled = 0
+        self.rejected = 0
+        self.expired = 0
+        self.flushed_writes = 0
+
+    @property
+    def db(self):
+        # import متأخر حتى يمكن استخدام الدفتر (والاختبارات) بدون Supabase
+        if self._db is None:
+            from db_service import db_service_instance
+            self._db = db_service_instance
+        return self._db
+
+    # ===== Counters =====
+    def read_token(self) -> int:
+        """يُؤخذ قبل قراءة المنتجات من قاعدة البيانات ويُمرَّر إلى seed"""
+        return self._epoch
+
+    def seed(self, products, token: int = None):
+        """
+        تهيئة العدادات من صفوف المنتجات. مع token من read_token() تُحدَّث أيضاً
+        قيم المنتجات المتتبعة، إلا إذا بدأ أو انتهى flush أثناء القراءة
+        (القيمة المقروءة قد لا تتضمن ما كتبه).
+        """
+        fresh = token is not None and token == self._epoch and not self._flush_lock.locked()
+        for product in products:
+            if not product or 'stock_quantity' not in product:
+                continue
+            stock = product.get('stock_quantity') or 0
+            product_id = product['id']
+            if product_id not in self._db_stock:
+                self._db_stock[product_id] = stock
+            elif fresh and self._db_stock[product_id] != stock:
+                self._db_stock[product_id] = stock
+                self.reconciled += 1
+
+    def is_tracked(self, product_id: int) -> bool:
+        return product_id in self._db_stock
+
+    def available(self, product_id: int) -> int:
+        """المخزون المتاح بعد الطلبات المؤكدة والحجوزات القائمة"""
+        return (self._db_stock.get(product_id, 0)
+                - self._pending.get(product_id, 0)
+                - self._reserved.get(product_id, 0))
+
+    def committed(self, product_id: int) -> int:
+        """المخزون بعد الطلبات المؤكدة (القيمة التي ستُكتب عند flush)"""
+        return max(self._db_stock.get(product_id, 0) - self._pending.get(product_id, 0), 0)
+
+    def apply(self, product: dict) -> dict:
+        """تحديث stock_quantity في صف منتج بالقيمة الحالية من الدفتر"""
+        if product and 'stock_quantity' in product and product.get('id') in self._db_stock:
+            product['stock_quantity'] = max(self.available(product['id']), 0)
+        return product
+
+    def set_stock(self, product_id: int, stock_quantity: int):
+        """قيمة مطلقة من الادمن تلغي الفروقات غير المكتوبة"""
+        self._db_stock[product_id] = stock_quantity
+        self._pending.pop(product_id, None)
+        self._failed.discard(product_id)
+        self._versions[product_id] = self._versions.get(product_id, 0) + 1
+
+    def forget(self, product_id: int):
+        """إزالة منتج محذوف من الدفتر"""
+        self._db_stock.pop(product_id, None)
+        self._pending.pop(product_id, None)
+        self._failed.discard(product_id)
+        self._versions[product_id] = self._versions.get(product_id, 0) + 1
+
+    # ===== Reservations =====
+    def reserve(self, items: dict, ttl: float = None) -> str:
+        """حجز كميات {product_id: quantity} دفعة واحدة أو رفض الحجز كاملاً"""
+        for product_id, quantity in items.items():
+            available = self.available(product_id) if product_id in self._db_stock else 0
+            if available < quantity:
+                self.rejected += 1
+                raise InsufficientStock(product_id, available)
+
+        for product_id, quantity in items.items():
+            self._reserved[product_id] = self._reserved.get(product_id, 0) + quantity
+
+        reservation_id = uuid.uuid4().hex
+        self._reservations[reservation_id] = (dict(items), time.monotonic() + (ttl or self.ttl))
+        return reservation_id
+
+    def commit(self, reservation_id: str) -> bool:
+        """تحويل الحجز إلى خصم دائم بانتظار الكتابة"""
+        reservation = self._reservations.pop(reservation_id, None)
+        if reservation is None:
+            return False
+        items, _ = reservation
+        for product_id, quantity in items.items():
+            self._reserved[product_id] -= quantity
+            self._pending[product_id] = self._pending.get(product_id, 0) + quantity
+        return True
+
+    def consume(self, items: dict):
+        """خصم مباشر بدون حجز (انتهاء الحجز قبل التأكيد، أو خصم مستعاد من الـ outbox)"""
+        for product_id, quantity in items.items():
+            self._pending[product_id] = self._pending.get(product_id, 0) + quantity
+
+    def release(self, reservation_id: str) -> bool:
+        """إلغاء الحجز وإعادة الكميات"""
+        reservation = self._reservations.pop(reservation_id, None)
+        if reservation is None:
+            return False
+        items, _ = reservation
+        for product_id, quantity in items.items():
+            self._reserved[product_id] -= quantity
+        return True
+
+    def expire(self) -> int:
+        """تحرير الحجوزات المنتهية"""
+        now = time.monotonic()
+        expired = [rid for rid, (_, expires_at) in self._reservations.items() if expires_at <= now]
+        for rid in expired:
+            self.release(rid)
+        self.expired += len(expired)
+        return len(expired)
+
+    # ===== Flushing =====
+    async def flush(self) -> int:
+        """كتابة الفروقات الصافية: كتابة واحدة لكل منتج تغيّر منذ آخر flush"""
+        async with self._flush_lock:
+            # منتج مستعاد من الـ outbox لم يُقرأ بعد من قاعدة البيانات ينتظر seed
+            dirty = {pid: delta for pid, delta in self._pending.items() if delta and pid in self._db_stock}
+            if not dirty:
+                return 0
+            self._epoch += 1
+            written = 0
+            for product_id, delta in dirty.items():
+                version = self._versions.get(product_id, 0)
+                new_stock = max(self._db_stock[product_id] - delta, 0)
+                try:
+                    updated = await self.db.update_product(product_id, {'stock_quantity': new_stock})
+                except Exception as e:
+                    logger.error("Inventory flush failed for product %s: %s", product_id, e)
+                    self._failed.add(product_id)
+                    continue
+                self._failed.discard(product_id)
+                if self._versions.get(product_id, 0) != version:
+                    # الادمن عيّن قيمة جديدة أثناء الكتابة
+                    continue
+                if not updated:
+                    self.forget(product_id)
+                    continue
+                self._db_stock[product_id] = new_stock
+                self._pending[product_id] -= delta
+                written += 1
+            self._epoch += 1
+            self.flushed_writes += written
+            if written and self.on_flush:
+                self.on_flush([pid for pid in dirty if not self._pending.get(pid)])
+            return written
+
+    async def settle(self, product_ids):
+        """
+        flush ثم التحقق أن كل الخصومات المؤكدة حتى الآن لهذه المنتجات كُتبت
+        (أو ألغتها قيمة من الادمن)، وإلا يرفع خطأ ليُعاد المحاولة
+        """
+        await self.flush()
+        unsettled = [pid for pid in product_ids
+                     if pid in self._failed or (self._pending.get(pid) and pid not in self._db_stock)]
+        if unsettled:
+            raise RuntimeError(f"Stock not written yet for products {unsettled}")
+
+    async def run_flusher(self, interval: float = INVENTORY_FLUSH_INTERVAL):
+        """حلقة خلفية: تحرير الحجوزات المنتهية وكتابة الفروقات"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.expire()
+                await self.flush()
+            except Exception as e:
+                logger.error("Inventory flusher error: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "tracked_products": len(self._db_stock),
+            "active_reservations": len(self._reservations),
+            "pending_units": sum(self._pending.values()),
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "reconciled": self.reconciled,
+            "flushed_writes": self.flushed_writes
+        }
+
+
+# إنشاء instance مشترك
+ledger = InventoryLedger()
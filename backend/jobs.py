@@ -0,0 +1,228 @@
+"""
+طابور مهام خلفية داخل العملية: outbox على القرص، إعادة محاولة، تزامن محدود وdead-letter
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+JOB_OUTBOX_PATH = os.getenv("JOB_OUTBOX_PATH", "job_outbox.jsonl")
+JOB_DEADLETTER_PATH = os.getenv("JOB_DEADLETTER_PATH", "job_deadletter.jsonl")
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "1"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "60"))
+# مهلة إنهاء المهام الموجودة في الطابور عند الإيقاف
+JOB_DRAIN_SECONDS = float(os.getenv("JOB_DRAIN_SECONDS", "5"))
+# إعادة كتابة الـ outbox بعد هذا العدد من المهام المنتهية
+JOB_COMPACT_EVERY = int(os.getenv("JOB_COMPACT_EVERY", "500"))
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    المهام durable تُكتب في outbox (JSONL) قبل الإرجاع وتُعاد جدولتها بعد إعادة
+    التشغيل حتى تنجح أو تنتقل إلى dead-letter. المهام غير durable (مثل تحديث
+    الفهارس في الذاكرة التي يُعاد بناؤها عند التشغيل) لا تُكتب على القرص.
+    recover يُستدعى بشكل متزامن لكل مهمة مستعادة قبل تشغيل العمال (لإعادة بناء
+    حالة في الذاكرة)، و retry_forever لمهام لا تنتقل إلى dead-letter أبداً.
+    """
+
+    def __init__(self, outbox_path: str = JOB_OUTBOX_PATH, deadletter_path: str = JOB_DEADLETTER_PATH,
+                 concurrency: int = JOB_CONCURRENCY, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.outbox_path = Path(outbox_path)
+        self.deadletter_path = Path(deadletter_path)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._handlers = {}
+        self._recover = {}        # name -> callback(payload) للمهام المستعادة من الـ outbox
+        self._retry_forever = set()  # أنواع مهام لا تنتقل إلى dead-letter
+        self._queue = None
+        self._workers = []
+        self._pending = {}        # job_id -> job (durable فقط)
+        self._file_lock = threading.Lock()
+        self._done_since_compact = 0
+        self.dead_letters = deque(maxlen=200)
+        self.completed = 0
+        self.failed_attempts = 0
+
+    def handler(self, name: str, recover=None, retry_forever: bool = False):
+        """تسجيل دالة async تنفذ نوع مهمة"""
+        def decorator(func):
+            self._handlers[name] = func
+            if retry_forever:
+                self._retry_forever.add(name)
+            if recover is not None:
+                self._recover[name] = recover
+            return func
+        return decorator
+
+    # ===== Persistence =====
+    def _append(self, path: Path, record: dict):
+        with self._file_lock:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def _compact(self):
+        """إعادة كتابة الـ outbox بالمهام المعلقة فقط"""
+        with self._file_lock:
+            tmp = self.outbox_path.with_suffix('.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for job in list(self._pending.values()):
+                    f.write(json.dumps({'op': 'enqueue', 'job': job}, default=str) + '\n')
+            tmp.replace(self.outbox_path)
+
+    def _load_outbox(self) -> list:
+        if not self.outbox_path.exists():
+            return []
+        pending = {}
+        with open(self.outbox_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # سطر ناقص من توقف مفاجئ
+                if record.get('op') == 'enqueue':
+                    pending[record['job']['id']] = record['job']
+                else:
+                    pending.pop(record.get('id'), None)
+        return list(pending.values())
+
+    # ===== Lifecycle =====
+    async def start(self):
+        """تحميل المهام المعلقة من الـ outbox وتشغيل العمال"""
+        self._queue = asyncio.Queue()
+        recovered = await asyncio.to_thread(self._load_outbox)
+        for job in recovered:
+            self._pending[job['id']] = job
+            recover = self._recover.get(job['name'])
+            if recover is not None:
+                try:
+                    recover(job['payload'])
+                except Exception as e:
+                    logger.error("Recovering job %s failed: %s", job['name'], e)
+            self._queue.put_nowait(job)
+        if recovered:
+            logger.info("Recovered %s pending jobs from outbox", len(recovered))
+        if self.outbox_path.exists():
+            await asyncio.to_thread(self._compact)
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.concurrency)]
+
+    async def drain(self, timeout: float = JOB_DRAIN_SECONDS):
+        """انتظار المهام الموجودة في الطابور (قبل stop) بحد أقصى timeout"""
+        if self._queue is None or not self._workers:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Job queue not drained, %s jobs left in the outbox", self._queue.qsize())
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    # ===== Enqueue =====
+    async def enqueue(self, name: str, payload: dict, durable: bool = True) -> str:
+        """إضافة مهمة. المهام durable تُكتب على القرص قبل الإرجاع"""
+        if name not in self._handlers:
+            raise KeyError(f"Unknown job type: {name}")
+        job = {
+            'id': uuid.uuid4().hex,
+            'name': name,
+            'payload': payload,
+            'attempts': 0,
+            'durable': durable,
+            'created_at': datetime.utcnow().isoformat()
+        }
+        if durable:
+            self._pending[job['id']] = job
+            await asyncio.to_thread(self._append, self.outbox_path, {'op': 'enqueue', 'job': job})
+        if self._queue is None:
+            # قبل start(): المهام durable ستُحمَّل من الـ outbox
+            if not durable:
+                logger.warning("Job queue not started, dropping %s", name)
+            return job['id']
+        self._queue.put_nowait(job)
+        return job['id']
+
+    # ===== Workers =====
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Job worker %s error: %s", index, e)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: dict):
+        handler = self._handlers.get(job['name'])
+        try:
+            if handler is None:
+                raise KeyError(f"Unknown job type: {job['name']}")
+            await handler(job['payload'])
+        except Exception as e:
+            job['attempts'] += 1
+            job['last_error'] = str(e)
+            self.failed_attempts += 1
+            if job['attempts'] >= self.max_attempts and job['name'] not in self._retry_forever:
+                await self._dead_letter(job)
+            else:
+                delay = min(JOB_RETRY_BASE_SECONDS * (2 ** min(job['attempts'] - 1, 16)), JOB_RETRY_MAX_SECONDS)
+                logger.warning("Job %s failed (attempt %s), retrying in %ss: %s", job['name'], job['attempts'], delay, e)
+                asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job)
+            return
+
+        self.completed += 1
+        if job.get('durable'):
+            await self._finish(job)
+
+    async def _finish(self, job: dict):
+        self._pending.pop(job['id'], None)
+        await asyncio.to_thread(self._append, self.outbox_path, {'op': 'done', 'id': job['id']})
+        self._done_since_compact += 1
+        if self._done_since_compact >= JOB_COMPACT_EVERY:
+            self._done_since_compact = 0
+            await asyncio.to_thread(self._compact)
+
+    async def _dead_letter(self, job: dict):
+        logger.error("Job %s moved to dead-letter after %s attempts: %s", job['name'], job['attempts'], job.get('last_error'))
+        job['dead_at'] = datetime.utcnow().isoformat()
+        self.dead_letters.append(job)
+        if job.get('durable'):
+            await asyncio.to_thread(self._append, self.deadletter_path, job)
+            self._pending.pop(job['id'], None)
+            await asyncio.to_thread(self._append, self.outbox_path, {'op': 'done', 'id': job['id']})
+
+    async def retry_dead(self, job_id: str) -> bool:
+        """إعادة مهمة من dead-letter إلى الطابور"""
+        for job in list(self.dead_letters):
+            if job['id'] == job_id:
+                self.dead_letters.remove(job)
+                await self.enqueue(job['name'], job['payload'], durable=job.get('durable', True))
+                return True
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "pending_durable": len(self._pending),
+            "workers": len(self._workers),
+            "completed": self.completed,
+            "failed_attempts": self.failed_attempts,
+            "dead_letters": len(self.dead_letters)
+        }
+
+
+# إنشاء instance مشترك
+job_queue = JobQueue()
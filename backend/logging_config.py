@@ -0,0 +1,185 @@
+"""
+سجلات غير حاجبة: QueueHandler في مسار الطلب و thread منفصل يكتب سجلات JSON مع request_id
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# أخذ عينة من سجلات INFO/DEBUG المزعجة لكل logger، مثال: "events=0.1,uvicorn.access=0.05"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+# uvicorn يضبط handlers متزامنة خاصة به مع propagate=False قبل استيراد التطبيق
+UVICORN_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+# قيم query لا تُكتب في السجلات (سطر الوصول يحتوي الـ URL كاملاً)
+REDACTED_QUERY_PARAMS = ("token", "access_token")
+_REDACT_RE = re.compile(r"([?&](?:%s)=)[^&\s\"]*" % "|".join(REDACTED_QUERY_PARAMS))
+
+request_id_var: ContextVar = ContextVar("request_id", default=None)
+
+_listener = None
+dropped = 0
+sampled_out = 0
+
+
+def parse_sampling(spec: str) -> dict:
+    """تحويل LOG_SAMPLING إلى {logger_name: كل كم سجل يُحتفظ بواحد}"""
+    every = {}
+    for entry in spec.split(','):
+        if '=' not in entry:
+            continue
+        name, rate = entry.rsplit('=', 1)
+        rate = float(rate)
+        if 0 < rate < 1:
+            every[name.strip()] = round(1 / rate)
+    return every
+
+
+class SamplingFilter(logging.Filter):
+    """يمرر سجلاً واحداً من كل N لـ INFO وما دون، و WARNING فما فوق دائماً"""
+
+    def __init__(self, every: dict):
+        super().__init__()
+        self.every = every
+        self._counts = {}
+
+    def filter(self, record) -> bool:
+        global sampled_out
+        if record.levelno >= logging.WARNING:
+            return True
+        n = self.every.get(record.name)
+        if not n:
+            return True
+        count = self._counts.get(record.name, 0)
+        self._counts[record.name] = count + 1
+        if count % n == 0:
+            return True
+        sampled_out += 1
+        return False
+
+
+class RedactQueryFilter(logging.Filter):
+    """يستبدل قيم REDACTED_QUERY_PARAMS في رسالة السجل ومعاملاته بـ ***"""
+
+    def filter(self, record) -> bool:
+        if isinstance(record.msg, str):
+            record.msg = _REDACT_RE.sub(r"\1***", record.msg)
+        if isinstance(record.args, tuple):
+            record.args = tuple(_REDACT_RE.sub(r"\1***", a) if isinstance(a, str) else a
+                                for a in record.args)
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    لا يُنسّق الرسالة في thread الطلب (التنسيق يتم في الـ listener)،
+    ويسقط السجل بدلاً من الانتظار إذا امتلأ الطابور.
+    """
+
+    def prepare(self, record):
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging():
+    """تهيئة الـ root logger مرة واحدة (آمنة للاستدعاء من أكثر من module)"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "json":
+        stream.setFormatter(JSONFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(request_id)s:%(message)s"))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    every = parse_sampling(LOG_SAMPLING)
+    if every:
+        handler.addFilter(SamplingFilter(every))
+    handler.addFilter(RedactQueryFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    for name in UVICORN_LOGGERS:
+        # سطر الوصول لكل طلب يمر أيضاً عبر الطابور (و LOG_SAMPLING)
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def stats() -> dict:
+    return {
+        "queued": _listener.queue.qsize() if _listener else 0,
+        "dropped": dropped,
+        "sampled_out": sampled_out
+    }
+
+
+class RequestIdMiddleware:
+    """Middleware ASGI: يأخذ X-Request-ID من الطلب أو يولّده، ويعيده في الاستجابة"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope.get("headers", []):
+            if key == b"x-request-id":
+                request_id = value.decode('latin-1')[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
@@ -1,14 +1,36 @@
-from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile, Form, Body, Request, Response, Header
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 from datetime import timedelta, datetime
 from typing import List, Optional
+from pydantic import ValidationError
 from db_service import db_service_instance as db
+from idempotency import idempotency_store, fingerprint, IdempotencyConflict
+from inventory import ledger, InsufficientStock
+from analytics import rollups
+from recommendations import co_purchases
+from facets import facet_index
+from jobs import job_queue
+from compression import JSONCompressionMiddleware
+from ratelimit import RateLimitMiddleware, rate_limiter
+import logging_config
+from logging_config import setup_logging, RequestIdMiddleware
+from media import media_store, shard_key, UPLOAD_DIR, MEDIA_GC_ENABLED, MediaGCRefused
+from snapshots import snapshot_builder, SnapshotFiles, slugify
+from images import image_resizer, snap_width, ImageNotFound, IMAGE_FORMATS
+from resilience import StaleHeaderMiddleware, CircuitOpenError, BREAKER_RESET_SECONDS
+import metrics
+from metrics import TimingMiddleware, render_metrics
+from events import broker, format_sse, EVENT_HEARTBEAT_SECONDS, LOW_STOCK_THRESHOLD
 
 import os
+import csv
+import time
+import asyncio
 import shutil
 import uuid
 import io  
@@ -30,8 +52,11 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY") or os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 BUCKET_NAME = os.getenv("BUCKET_NAME", "product-images")
 
+# الحد الأقصى للمنتجات في /products/batch و /cart/quote
+BATCH_MAX_IDS = int(os.getenv("BATCH_MAX_IDS", "100"))
+
 # إعداد اللوقر أولاً
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # إنشاء عميل Supabase
@@ -39,23 +64,28 @@ supabase_storage: Client = None
 if SUPABASE_URL and SUPABASE_KEY:
     try:
         supabase_storage = create_client(SUPABASE_URL, SUPABASE_KEY)
+        media_store.bucket = supabase_storage.storage.from_(BUCKET_NAME)
         logger.info("Supabase Storage initialized")
     except Exception as e:
-        logger.error(f"Supabase init failed: {e}")
+        logger.error("Supabase init failed: %s", e)
 
 # استيراد Auth & Models
 from auth import (
     create_access_token, 
+    create_stream_token,
     authenticate_user, 
     get_current_active_user,
+    get_stream_user,
     setup_default_admin,
-    ACCESS_TOKEN_EXPIRE_MINUTES
+    ACCESS_TOKEN_EXPIRE_MINUTES,
+    STREAM_TOKEN_EXPIRE_SECONDS
 )
 
 from models import (
     Product, ProductCreate, ProductUpdate,
     Order, OrderCreate, OrderUpdate, OrderStatus,
-    Token, FileUploadResponse, DashboardStats, OrderItemCreate
+    Token, FileUploadResponse, DashboardStats, OrderItemCreate,
+    BulkProductResponse, CartQuoteRequest, CartQuote
 )
 
 # إعداد التطبيق
@@ -77,6 +107,11 @@ class ApiPrefixMiddleware(BaseHTTPMiddleware):
         return response
 
 app.add_middleware(ApiPrefixMiddleware)
+app.add_middleware(JSONCompressionMiddleware)
+app.add_middleware(StaleHeaderMiddleware)
+app.add_middleware(TimingMiddleware)
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+app.add_middleware(RequestIdMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -84,12 +119,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
 # إعداد المجلدات
-UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/snapshots", SnapshotFiles(snapshot_builder), name="snapshots")
 
 # ===== Helper Functions =====
 def _make_absolute_media(product: dict) -> dict:
@@ -118,21 +154,74 @@ def _make_absolute_media(product: dict) -> dict:
         pass
     return product
 
+def _service_unavailable() -> HTTPException:
+    """503 مع Retry-After عند فتح قاطع الدائرة وعدم وجود بيانات قديمة صالحة (العميل يعيد المحاولة لاحقاً)"""
+    return HTTPException(
+        status_code=503,
+        detail="Service temporarily unavailable",
+        headers={"Retry-After": str(int(BREAKER_RESET_SECONDS))}
+    )
+
+# ===== Sparse Fieldsets =====
+PRODUCT_FIELDS = {
+    'id', 'name', 'description', 'price', 'category', 'image_url', 'images',
+    'stock_quantity', 'is_available', 'created_at', 'updated_at',
+    'image'  # حقل افتراضي: أول صورة فقط (لبطاقات المنتجات)
+}
+ORDER_FIELDS = {
+    'id', 'customer_info', 'status', 'total_amount', 'notes', 'created_at', 'updated_at',
+    'items'  # حقل افتراضي: عناصر الطلب (استعلام إضافي لكل طلب)
+}
+
+def _parse_fields(fields: Optional[str], allowed: set) -> Optional[List[str]]:
+    """تحليل معامل fields= والتحقق من الحقول المسموحة"""
+    if not fields:
+        return None
+    requested = list(dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()))
+    unknown = [f for f in requested if f not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def _select_columns(requested: Optional[List[str]], *required: str) -> str:
+    """بناء select(...) لـ Supabase من الحقول المطلوبة وحقول الفلترة"""
+    if requested is None:
+        return '*'
+    columns = {'id', *required}
+    for field in requested:
+        if field == 'image':
+            columns.update(('images', 'image_url'))
+        elif field != 'items':
+            columns.add(field)
+    return ','.join(sorted(columns))
+
+def _project(row: dict, requested: List[str]) -> dict:
+    """إرجاع الحقول المطلوبة فقط من الصف"""
+    if 'image' in requested:
+        images = row.get('images') or []
+        row['image'] = images[0] if images else row.get('image_url')
+    return {field: row.get(field) for field in requested}
+
 async def upload_to_supabase(file_content: bytes, filename: str, content_type: str) -> str:
     """رفع ملف إلى Supabase Storage"""
     try:
         if not supabase_storage:
             raise Exception("Supabase not initialized")
         
-        logger.info(f"Uploading {filename} ({len(file_content)} bytes)")
-        
-        result = supabase_storage.storage.from_(BUCKET_NAME).upload(
-            path=filename,
-            file=file_content,
-            file_options={"content-type": content_type}
-        )
+        logger.info("Uploading %s (%s bytes)", filename, len(file_content))
         
-        logger.info(f"Supabase upload response: {result}")
+        started = time.perf_counter()
+        try:
+            result = supabase_storage.storage.from_(BUCKET_NAME).upload(
+                path=filename,
+                file=file_content,
+                file_options={"content-type": content_type}
+            )
+        except Exception:
+            metrics.STORAGE_LATENCY.observe(time.perf_counter() - started, "error")
+            raise
+        metrics.STORAGE_LATENCY.observe(time.perf_counter() - started, "ok")
+        metrics.STORAGE_BYTES.inc(amount=len(file_content))
         
         if isinstance(result, dict):
             if result.get("error"):
@@ -141,12 +230,12 @@ async def upload_to_supabase(file_content: bytes, filename: str, content_type: s
                 raise Exception(result.get("message", "Upload failed"))
         
         public_url = f"{SUPABASE_URL}/storage/v1/object/public/{BUCKET_NAME}/{filename}"
-        logger.info(f"Upload success: {public_url}")
+        logger.info("Upload success: %s", public_url)
         
         return public_url
         
     except Exception as e:
-        logger.error(f"Supabase upload failed: {e}")
+        logger.error("Supabase upload failed: %s", e)
         raise
 
 
@@ -154,10 +243,29 @@ async def upload_to_supabase(file_content: bytes, filename: str, content_type: s
 @app.on_event("startup")
 async def startup_event():
     try:
+        await job_queue.start()
         await setup_default_admin()
+        app.state.inventory_flusher = asyncio.create_task(ledger.run_flusher())
+        app.state.index_build = asyncio.create_task(_build_indexes())
+        if MEDIA_GC_ENABLED:
+            app.state.media_gc = asyncio.create_task(media_store.run_collector(_load_media_refs))
         logger.info("App started successfully")
     except Exception as e:
-        logger.error(f"Startup error: {e}")
+        logger.error("Startup error: %s", e)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task_name in ("inventory_flusher", "media_gc"):
+        task = getattr(app.state, task_name, None)
+        if task:
+            task.cancel()
+    try:
+        await ledger.flush()
+    except Exception as e:
+        logger.error("Shutdown inventory flush error: %s", e)
+    # مهام الخصم التي كتبها flush تكتمل الآن فلا تُعاد بعد إعادة التشغيل
+    await job_queue.drain()
+    await job_queue.stop()
 
 # ===== Health Check =====
 @app.get("/health")
@@ -173,6 +281,31 @@ async def get_status():
         "bucket_name": BUCKET_NAME
     }
 
+# ===== Metrics =====
+metrics.Gauge("event_subscribers", "Connected admin event stream clients", lambda: broker.stats()["subscribers"])
+metrics.Gauge("inventory_active_reservations", "Open inventory reservations", lambda: ledger.stats()["active_reservations"])
+metrics.Gauge("inventory_pending_units", "Committed units not yet flushed to products", lambda: ledger.stats()["pending_units"])
+metrics.Gauge("db_circuit_open", "1 while the Supabase circuit breaker rejects calls",
+              lambda: int(db.executor.breaker.state != "closed"))
+metrics.Gauge("jobs_queued", "Background jobs waiting for a worker", lambda: job_queue.stats()["queued"])
+metrics.Gauge("jobs_dead_letters", "Background jobs in the dead-letter list", lambda: len(job_queue.dead_letters))
+metrics.Gauge("idempotency_keys", "Stored idempotency keys", lambda: idempotency_store.stats()["keys"])
+metrics.Gauge("http_inflight_requests", "Requests currently being handled", lambda: rate_limiter.inflight)
+metrics.Gauge("http_rate_limited_total", "Requests rejected with 429 by the token buckets",
+              lambda: sum(rate_limiter.limited.values()))
+metrics.Gauge("log_queue_depth", "Log records waiting for the writer thread", lambda: logging_config.stats()["queued"])
+metrics.Gauge("log_records_dropped_total", "Log records dropped because the queue was full",
+              lambda: logging_config.dropped)
+metrics.Gauge("log_records_sampled_out_total", "Log records skipped by LOG_SAMPLING",
+              lambda: logging_config.sampled_out)
+metrics.Gauge("media_gc_reclaimed_bytes_total", "Bytes freed by the media garbage collector",
+              lambda: media_store.reclaimed_bytes)
+metrics.Gauge("http_shed_total", "Requests rejected with 503 by the in-flight limit", lambda: rate_limiter.shed)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 # ===== Auth Endpoints =====
 @app.post("/admin/login", response_model=Token)
 async def admin_login(form_data: OAuth2PasswordRequestForm = Depends()):
@@ -201,12 +334,58 @@ async def get_current_admin(current_user=Depends(get_current_active_user)):
         "is_active": current_user["is_active"]
     }
 
+# ===== Catalog Hooks =====
+def _on_products_written(rows: list):
+    """تحديث الفهارس الداخلية بعد كتابة منتجات (مرة واحدة لكل دفعة)"""
+    for row in rows:
+        if row:
+            co_purchases.set_product(row)
+            facet_index.upsert(ledger.apply(dict(row)))
+    snapshot_builder.schedule()
+
+def _on_product_deleted(product_id: int):
+    """إزالة منتج محذوف من الفهارس الداخلية"""
+    ledger.forget(product_id)
+    co_purchases.remove_product(product_id)
+    facet_index.remove(product_id)
+    snapshot_builder.schedule()
+
+def _on_stock_changed(product_ids):
+    """تحديث الفهارس بعد تغيّر المخزون في الدفتر (الطلبات)"""
+    for product_id in product_ids:
+        facet_index.set_stock(product_id, max(ledger.available(product_id), 0))
+    snapshot_builder.schedule()
+
+async def _render_snapshots() -> dict:
+    """محتوى لقطات الكتالوج: كل المنتجات، الفئات، ومنتجات كل فئة"""
+    if not facet_index.built:
+        facet_index.build([ledger.apply(dict(p)) for p in await db.get_all_products()])
+    rows, _ = facet_index.query()
+    products = jsonable_encoder([Product(**_make_absolute_media(ledger.apply(dict(p)))) for p in rows])
+    by_category = {}
+    for product in products:
+        if product.get('category'):
+            by_category.setdefault(product['category'], []).append(product)
+    documents = {
+        "products.json": products,
+        "categories.json": {"categories": sorted(by_category)}
+    }
+    for category, items in by_category.items():
+        documents[f"category-{slugify(category)}.json"] = {"category": category, "products": items}
+    return documents
+
+snapshot_builder.render = _render_snapshots
+ledger.on_flush = _on_stock_changed
+
 # ===== Products =====
 @app.get("/products", response_model=List[Product])
-async def get_products(skip: int = 0, limit: int = 50, category: Optional[str] = None, search: Optional[str] = None):
+async def get_products(skip: int = 0, limit: int = 50, category: Optional[str] = None, search: Optional[str] = None,
+                       fields: Optional[str] = None):
+    requested = _parse_fields(fields, PRODUCT_FIELDS)
+    filter_columns = (['category'] if category else []) + (['name', 'description'] if search else [])
     try:
-        products = await db.get_all_products()
-        products = [_make_absolute_media(dict(p)) for p in products]
+        products = await db.get_all_products(_select_columns(requested, *filter_columns))
+        products = [_make_absolute_media(ledger.apply(dict(p))) for p in products]
         
         if category:
             products = [p for p in products if p.get('category', '').lower() == category.lower()]
@@ -217,23 +396,159 @@ async def get_products(skip: int = 0, limit: int = 50, category: Optional[str] =
                        search_lower in p.get('name', '').lower() or 
                        search_lower in p.get('description', '').lower()]
         
-        return products[skip:skip + limit]
+        page = products[skip:skip + limit]
+        if requested:
+            return JSONResponse([_project(p, requested) for p in page])
+        return page
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Error fetching products: {e}")
+        logger.error("Error fetching products: %s", e)
         raise HTTPException(status_code=500, detail="Error fetching products")
 
+async def _resolve_products(product_ids, fresh: bool = False) -> dict:
+    """
+    صفوف المنتجات من فهرس الكتالوج، والناقص منها باستعلام in_ واحد. مع fresh تُقرأ
+    كلها من قاعدة البيانات (السعر والتوفر كما في إنشاء الطلب)، ويُحدَّث الفهرس بما
+    تغيّر خارج الـ API (لوحة Supabase).
+    """
+    rows = {}
+    missing = []
+    for product_id in dict.fromkeys(product_ids):
+        row = facet_index.get(product_id) if facet_index.built and not fresh else None
+        if row is None:
+            missing.append(product_id)
+        else:
+            rows[product_id] = row
+    if missing:
+        token = ledger.read_token()
+        fetched = await db.get_products_by_ids(missing)
+        ledger.seed(fetched, token)
+        rows.update((p['id'], p) for p in fetched)
+        if fresh and facet_index.built:
+            _sync_index(missing, rows)
+    return {pid: _make_absolute_media(ledger.apply(dict(p))) for pid, p in rows.items()}
+
+def _sync_index(product_ids, rows: dict):
+    """مقارنة صفوف قاعدة البيانات بالفهرس (بدون المخزون الذي يديره الدفتر) وتحديث المتغير فقط"""
+    changed = []
+    for product_id in product_ids:
+        indexed = facet_index.get(product_id)
+        row = rows.get(product_id)
+        if row is None:
+            if indexed is not None:
+                _on_product_deleted(product_id)
+        elif indexed is None or any(indexed.get(k) != v for k, v in row.items() if k != 'stock_quantity'):
+            changed.append(row)
+        elif ledger.is_tracked(product_id) and indexed.get('stock_quantity') != max(ledger.available(product_id), 0):
+            # seed دمج تعديل مخزون خارجي
+            facet_index.set_stock(product_id, max(ledger.available(product_id), 0))
+    if changed:
+        _on_products_written(changed)
+
+@app.get("/products/batch", response_model=List[Product])
+async def get_products_batch(ids: str):
+    """عدة منتجات في طلب واحد بنفس ترتيب ids (المعرفات غير الموجودة تُتجاهل)"""
+    try:
+        product_ids = [int(i) for i in ids.split(',') if i.strip()]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="ids must be comma-separated integers")
+    if len(product_ids) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {BATCH_MAX_IDS} ids per request")
+    try:
+        products = await _resolve_products(product_ids, fresh=True)
+    except CircuitOpenError:
+        raise _service_unavailable()
+    except Exception as e:
+        logger.error("Batch products error: %s", e)
+        raise HTTPException(status_code=500, detail="Error")
+    return [products[pid] for pid in dict.fromkeys(product_ids) if pid in products]
+
 @app.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: int):
     try:
         product = await db.get_product_by_id(product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
-        return _make_absolute_media(dict(product))
+        return _make_absolute_media(ledger.apply(dict(product)))
+    except HTTPException:
+        raise
+    except CircuitOpenError:
+        raise _service_unavailable()
+    except Exception as e:
+        logger.error("Error fetching product: %s", e)
+        raise HTTPException(status_code=500, detail="Error")
+
+@app.get("/catalog")
+async def browse_catalog(
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    available: Optional[bool] = None,
+    in_stock: Optional[bool] = None,
+    q: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 50
+):
+    """تصفح الكتالوج بفلاتر مركّبة مع عدّادات كل فلتر"""
+    if not facet_index.built:
+        try:
+            facet_index.build([ledger.apply(dict(p)) for p in await db.get_all_products()])
+        except CircuitOpenError:
+            raise _service_unavailable()
+        except Exception as e:
+            logger.error("Facet index build error: %s", e)
+            raise HTTPException(status_code=500, detail="Error")
+    rows, facets = facet_index.query(category, min_price, max_price, available, in_stock, q)
+    page = [_make_absolute_media(ledger.apply(dict(p))) for p in rows[skip:skip + limit]]
+    return {
+        "products": jsonable_encoder([Product(**p) for p in page]),
+        "total": len(rows),
+        "skip": skip,
+        "limit": limit,
+        "facets": facets
+    }
+
+@app.get("/products/{product_id}/related", response_model=List[Product])
+async def get_related_products(product_id: int, limit: int = 4):
+    """منتجات تُشترى غالباً مع هذا المنتج (مع منتجات من نفس الفئة عند قلة البيانات)"""
+    limit = max(1, min(limit, 20))
+    try:
+        if not co_purchases.knows(product_id):
+            # منتج أُضيف خارج الـ API بعد بناء الفهرس، أو معرف غير موجود
+            product = (await _resolve_products([product_id])).get(product_id)
+            if product is None:
+                raise HTTPException(status_code=404, detail="Product not found")
+            co_purchases.set_product(product)
+        # مرشحون إضافيون تحسباً لصفوف تغيّرت منذ آخر تحديث للفهرس
+        ranked = co_purchases.related(product_id, limit * 2)
+        if not ranked:
+            return []
+        rows = await _resolve_products([r['product_id'] for r in ranked])
     except HTTPException:
         raise
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Error fetching product: {e}")
+        logger.error("Related products error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
+    return [
+        rows[r['product_id']]
+        for r in ranked
+        if r['product_id'] in rows and rows[r['product_id']].get('is_available', True)
+    ][:limit]
+
+@app.get("/admin/catalog/stats")
+async def catalog_index_stats(current_user=Depends(get_current_active_user)):
+    return facet_index.stats()
+
+@app.get("/admin/catalog/snapshots")
+async def catalog_snapshot_stats(current_user=Depends(get_current_active_user)):
+    return snapshot_builder.stats()
+
+@app.get("/admin/recommendations/stats")
+async def recommendation_stats(current_user=Depends(get_current_active_user)):
+    return co_purchases.stats()
 
 @app.post("/admin/products", response_model=Product)
 async def create_product(product: ProductCreate, current_user=Depends(get_current_active_user)):
@@ -246,9 +561,12 @@ async def create_product(product: ProductCreate, current_user=Depends(get_curren
         if not new_product:
             raise HTTPException(status_code=400, detail="Error creating product")
         
+        _on_products_written([new_product])
         return _make_absolute_media(dict(new_product))
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Error creating product: {e}")
+        logger.error("Error creating product: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
 @app.put("/admin/products/{product_id}", response_model=Product)
@@ -262,11 +580,18 @@ async def update_product(product_id: int, product: ProductUpdate, current_user=D
         update_data['updated_at'] = datetime.utcnow().isoformat()
         
         updated = await db.update_product(product_id, update_data)
+        if 'stock_quantity' in update_data:
+            ledger.set_stock(product_id, update_data['stock_quantity'])
+        _on_products_written([updated])
+        broker.publish("product_updated", updated)
+        broker.publish_stock(updated)
         return _make_absolute_media(dict(updated))
     except HTTPException:
         raise
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Update error: {e}")
+        logger.error("Update error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
 @app.delete("/admin/products/{product_id}")
@@ -277,50 +602,247 @@ async def delete_product(product_id: int, current_user=Depends(get_current_activ
             raise HTTPException(status_code=404, detail="Not found")
         
         await db.delete_product(product_id)
+        _on_product_deleted(product_id)
         return {"success": True, "message": "Deleted"}
     except HTTPException:
         raise
+    except CircuitOpenError:
+        raise _service_unavailable()
+    except Exception as e:
+        logger.error("Delete error: %s", e)
+        raise HTTPException(status_code=500, detail="Error")
+
+# ===== Bulk Products =====
+def _parse_products_csv(content: bytes) -> List[dict]:
+    """تحويل ملف CSV إلى صفوف منتجات (الصور مفصولة بـ |)"""
+    rows = []
+    reader = csv.DictReader(io.StringIO(content.decode('utf-8-sig')))
+    for raw in reader:
+        row = {k.strip(): v.strip() for k, v in raw.items() if k and v is not None and v.strip() != ''}
+        if 'images' in row:
+            row['images'] = [it.strip() for it in row['images'].split('|') if it.strip()]
+        rows.append(row)
+    return rows
+
+async def _bulk_upsert(rows: List[dict]):
+    """التحقق من الدفعة كاملة ثم تنفيذ الإدراج/التحديث الجماعي"""
+    results = []
+    prepared = []
+    now = datetime.utcnow().isoformat()
+
+    # التحقق من جميع الصفوف قبل أي كتابة
+    validated = []
+    seen_ids = set()
+    for idx, raw in enumerate(rows):
+        try:
+            if not isinstance(raw, dict):
+                raise ValueError("Row must be an object")
+            if raw.get('id') not in (None, ''):
+                product_id = int(raw['id'])
+                if product_id in seen_ids:
+                    raise ValueError(f"Duplicate id {product_id} in batch")
+                seen_ids.add(product_id)
+                validated.append((idx, product_id, ProductUpdate(**raw)))
+            else:
+                validated.append((idx, None, ProductCreate(**raw)))
+        except (ValidationError, ValueError, TypeError) as e:
+            results.append({"row": idx, "success": False, "error": str(e)})
+
+    existing = {p['id']: p for p in await db.get_products_by_ids(list(seen_ids))} if seen_ids else {}
+    for idx, product_id, model in validated:
+        if product_id is None:
+            data = model.dict()
+            data['created_at'] = now
+            prepared.append((idx, data))
+        elif product_id not in existing:
+            results.append({"row": idx, "success": False, "id": product_id, "error": "Product not found"})
+        else:
+            data = dict(existing[product_id])
+            data.update({k: v for k, v in model.dict().items() if v is not None})
+            if model.stock_quantity is None and ledger.is_tracked(product_id):
+                # لا نكتب فوق خصومات الطلبات التي لم تُكتب بعد
+                data['stock_quantity'] = ledger.committed(product_id)
+            data['updated_at'] = now
+            prepared.append((idx, data))
+
+    if results:
+        results.sort(key=lambda r: r['row'])
+        return {
+            "success": False, "total": len(rows), "created": 0, "updated": 0,
+            "failed": len(results), "results": results
+        }
+
+    written = await db.bulk_upsert_products([data for _, data in prepared])
+    created = updated = 0
+    for (idx, data), row in zip(prepared, written):
+        action = "updated" if data.get('id') else "created"
+        if isinstance(row, Exception) or not row:
+            results.append({"row": idx, "success": False, "action": action, "id": data.get('id'),
+                            "error": str(row) if row else "No row returned"})
+            continue
+        if action == "created":
+            created += 1
+        else:
+            updated += 1
+            if rows[idx].get('stock_quantity') not in (None, ''):
+                ledger.set_stock(row['id'], row.get('stock_quantity') or 0)
+        results.append({"row": idx, "success": True, "action": action, "id": row.get('id')})
+
+    failed = len(rows) - created - updated
+    _on_products_written([row for row in written if isinstance(row, dict)])
+    broker.publish("products_bulk_updated", {"created": created, "updated": updated})
+    logger.info("Bulk products: %s created, %s updated, %s failed", created, updated, failed)
+    return {
+        "success": failed == 0, "total": len(rows), "created": created, "updated": updated,
+        "failed": failed, "results": results
+    }
+
+def _bulk_response(result: dict):
+    if not result["success"] and result["created"] == 0 and result["updated"] == 0:
+        return JSONResponse(status_code=422, content=result)
+    return result
+
+@app.post("/admin/products/bulk", response_model=BulkProductResponse)
+async def bulk_products(rows: List[dict] = Body(...), current_user=Depends(get_current_active_user)):
+    try:
+        return _bulk_response(await _bulk_upsert(rows))
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Delete error: {e}")
+        logger.error("Bulk products error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
+@app.post("/admin/products/bulk/csv", response_model=BulkProductResponse)
+async def bulk_products_csv(file: UploadFile = File(...), current_user=Depends(get_current_active_user)):
+    try:
+        rows = _parse_products_csv(await file.read())
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid CSV: {e}")
+    try:
+        return _bulk_response(await _bulk_upsert(rows))
+    except CircuitOpenError:
+        raise _service_unavailable()
+    except Exception as e:
+        logger.error("Bulk products CSV error: %s", e)
+        raise HTTPException(status_code=500, detail="Error")
+
+# ===== Cart =====
+@app.post("/cart/quote", response_model=CartQuote)
+async def quote_cart(cart: CartQuoteRequest):
+    """تسعير السلة والتحقق من المخزون قبل إنشاء الطلب"""
+    if len(cart.items) > BATCH_MAX_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {BATCH_MAX_IDS} items per request")
+    requested = {}
+    for item in cart.items:
+        requested[item.product_id] = requested.get(item.product_id, 0) + item.quantity
+    try:
+        # نفس قراءة إنشاء الطلب حتى لا يختلف السعر أو التوفر بين العرض والدفع
+        products = await _resolve_products(requested, fresh=True)
+    except CircuitOpenError:
+        raise _service_unavailable()
+    except Exception as e:
+        logger.error("Cart quote error: %s", e)
+        raise HTTPException(status_code=500, detail="Error")
+
+    lines = []
+    total_amount = 0
+    for product_id, quantity in requested.items():
+        product = products.get(product_id)
+        line = {'product_id': product_id, 'quantity': quantity, 'product': product}
+        if product is None:
+            line['warning'] = 'not_found'
+            lines.append(line)
+            continue
+        available = (ledger.available(product_id) if ledger.is_tracked(product_id)
+                     else product.get('stock_quantity') or 0)
+        line['available_quantity'] = max(available, 0)
+        line['price_per_unit'] = product['price']
+        line['total_price'] = product['price'] * quantity
+        total_amount += line['total_price']
+        if not product.get('is_available', True):
+            line['warning'] = 'unavailable'
+        elif available <= 0:
+            line['warning'] = 'out_of_stock'
+        elif quantity > available:
+            line['warning'] = 'insufficient_stock'
+        lines.append(line)
+
+    return {
+        'items': lines,
+        'total_amount': total_amount,
+        'can_checkout': bool(lines) and not any(line.get('warning') for line in lines)
+    }
+
 # ===== Orders =====
 @app.get("/admin/orders", response_model=List[Order])
-async def get_orders(current_user=Depends(get_current_active_user), skip: int = 0, limit: int = 50, status: Optional[str] = None):
+async def get_orders(current_user=Depends(get_current_active_user), skip: int = 0, limit: int = 50, status: Optional[str] = None,
+                     fields: Optional[str] = None, product_fields: Optional[str] = None):
+    requested = _parse_fields(fields, ORDER_FIELDS)
+    product_requested = _parse_fields(product_fields, PRODUCT_FIELDS - {'image'})
     try:
-        orders = await db.get_all_orders()
+        orders = await db.get_all_orders(_select_columns(requested, 'status'))
         
         if status:
             orders = [o for o in orders if o.get('status') == status]
         
         orders = orders[skip:skip + limit]
         
-        for order in orders:
-            order['items'] = await db.get_order_items(order['id'])
+        if requested is None or 'items' in requested:
+            product_columns = _select_columns(product_requested)
+            for order in orders:
+                order['items'] = await db.get_order_items(order['id'], product_columns)
         
+        if requested:
+            return JSONResponse(jsonable_encoder([_project(o, requested) for o in orders]))
         return orders
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Orders error: {e}")
+        logger.error("Orders error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
 @app.get("/orders", response_model=List[Order])
-async def get_orders_alias(current_user=Depends(get_current_active_user), skip: int = 0, limit: int = 50, status: Optional[str] = None):
-    return await get_orders(current_user, skip, limit, status)
+async def get_orders_alias(current_user=Depends(get_current_active_user), skip: int = 0, limit: int = 50, status: Optional[str] = None,
+                           fields: Optional[str] = None, product_fields: Optional[str] = None):
+    return await get_orders(current_user, skip, limit, status, fields, product_fields)
 
 @app.post("/orders", response_model=Order)
-async def create_order(order_data: OrderCreate):
+async def create_order(
+    order_data: OrderCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    if not idempotency_key:
+        return await _place_order(order_data)
+    try:
+        order, replayed = await idempotency_store.run(
+            idempotency_key, fingerprint(order_data.dict()), lambda: _place_order(order_data)
+        )
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request")
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return order
+
+async def _place_order(order_data: OrderCreate):
+    """تنفيذ إنشاء الطلب (المنتجات، الطلب، العناصر، المخزون)"""
     try:
         total_amount = 0
         order_items_data = []
         
+        requested = {}
+        for item in order_data.items:
+            requested[item.product_id] = requested.get(item.product_id, 0) + item.quantity
+        token = ledger.read_token()
+        products = {p['id']: p for p in await db.get_products_by_ids(list(requested))}
+        # دمج تعديلات المخزون التي تمت خارج العملية قبل الحجز
+        ledger.seed(products.values(), token)
+        
         for item in order_data.items:
-            product = await db.get_product_by_id(item.product_id)
+            product = products.get(item.product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
             
-            if product['stock_quantity'] < item.quantity:
-                raise HTTPException(status_code=400, detail=f"Insufficient stock")
-            
             item_total = product['price'] * item.quantity
             total_amount += item_total
             
@@ -339,29 +861,88 @@ async def create_order(order_data: OrderCreate):
             'created_at': datetime.utcnow().isoformat()
         }
         
-        new_order = await db.create_order(order_create_data)
-        if not new_order:
-            raise HTTPException(status_code=400, detail="Error creating order")
-        
-        for item_data in order_items_data:
-            item_data['order_id'] = new_order['id']
+        try:
+            reservation_id = ledger.reserve(requested)
+        except InsufficientStock:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock")
         
-        order_items = await db.create_order_items(order_items_data)
+        try:
+            new_order = await db.create_order(order_create_data)
+            if not new_order:
+                raise HTTPException(status_code=400, detail="Error creating order")
+            
+            for item_data in order_items_data:
+                item_data['order_id'] = new_order['id']
+            
+            order_items = await db.create_order_items(order_items_data)
+        except BaseException:
+            ledger.release(reservation_id)
+            raise
         
-        for item in order_data.items:
-            product = await db.get_product_by_id(item.product_id)
-            new_stock = product['stock_quantity'] - item.quantity
-            await db.update_product(item.product_id, {'stock_quantity': new_stock})
+        # الخصم يُكتب إلى products لاحقاً عبر ledger.flush، ويُسجَّل في الـ outbox قبل الرد
+        if not ledger.commit(reservation_id):
+            logger.warning("Reservation expired before commit for order %s", new_order['id'])
+            ledger.consume(requested)
+        try:
+            await job_queue.enqueue("stock_committed", {
+                "order_id": new_order['id'],
+                "items": list(requested.items())
+            })
+        except Exception as e:
+            logger.error("Stock outbox write failed for order %s: %s", new_order['id'], e)
+        _on_stock_changed(products.keys())
+        for product_id, product in products.items():
+            broker.publish_stock(ledger.apply(dict(product)))
         
         new_order['items'] = order_items
+        broker.publish("order_created", new_order)
+        # الفهارس في الذاكرة يُعاد بناؤها عند التشغيل فلا تحتاج outbox
+        await job_queue.enqueue("order_created", {
+            "order": new_order,
+            "product_ids": list(requested.keys())
+        }, durable=False)
         return new_order
         
     except HTTPException:
         raise
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Order creation error: {e}")
+        logger.error("Order creation error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
+# ===== Background Jobs =====
+@job_queue.handler("order_created")
+async def _job_order_created(payload: dict):
+    """تحديث التجميعات ومصفوفة التوصيات بعد إنشاء الطلب"""
+    rollups.record_order_created(payload["order"])
+    co_purchases.record_order(payload["product_ids"])
+
+def _recover_stock(payload: dict):
+    """إعادة خصم مؤكد لم يُكتب قبل توقف العملية إلى الدفتر (قبل خدمة أي طلب)"""
+    ledger.consume(dict(payload["items"]))
+
+@job_queue.handler("stock_committed", recover=_recover_stock, retry_forever=True)
+async def _job_stock_committed(payload: dict):
+    """يكتمل بعد كتابة خصم الطلب إلى products، ويبقى في الـ outbox حتى ذلك"""
+    product_ids = [product_id for product_id, _ in payload["items"]]
+    untracked = [pid for pid in product_ids if not ledger.is_tracked(pid)]
+    if untracked:
+        token = ledger.read_token()
+        ledger.seed(await db.get_products_by_ids(untracked), token)
+        for pid in untracked:
+            if not ledger.is_tracked(pid):
+                ledger.forget(pid)  # المنتج حُذف
+    await ledger.settle(product_ids)
+
+@job_queue.handler("order_status_changed")
+async def _job_order_status_changed(payload: dict):
+    """تحديث تجميعات الإيراد بعد تغيير الحالة (قراءة العناصر عند الحاجة فقط)"""
+    order, previous_status, new_status = payload["order"], payload["previous_status"], payload["status"]
+    if rollups.needs_items(previous_status, new_status):
+        items = await db.get_order_items(order['id'])
+        rollups.record_status_change(order, items, previous_status, new_status)
+
 @app.put("/admin/orders/{order_id}/status")
 async def update_order_status(order_id: int, status_update: OrderUpdate, current_user=Depends(get_current_active_user)):
     try:
@@ -370,18 +951,93 @@ async def update_order_status(order_id: int, status_update: OrderUpdate, current
             raise HTTPException(status_code=404, detail="Not found")
         
         updated = await db.update_order_status(order_id, status_update.status.value)
+        broker.publish("order_status_changed", {
+            "order_id": order_id,
+            "previous_status": existing.get('status'),
+            "status": status_update.status.value,
+            "order": updated
+        })
+        await job_queue.enqueue("order_status_changed", {
+            "order": updated or existing,
+            "previous_status": existing.get('status'),
+            "status": status_update.status.value
+        }, durable=False)
         return {"success": True, "order": updated}
     except HTTPException:
         raise
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Status update error: {e}")
+        logger.error("Status update error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
+# ===== Admin Event Stream =====
+@app.post("/admin/events/token")
+async def admin_events_token(current_user=Depends(get_current_active_user)):
+    """token قصير العمر لـ EventSource بدلاً من تمرير token الدخول في الـ URL"""
+    return {"token": create_stream_token(current_user["email"]), "expires_in": STREAM_TOKEN_EXPIRE_SECONDS}
+
+@app.get("/admin/events")
+async def admin_events(request: Request, current_user=Depends(get_stream_user)):
+    """بث الطلبات الجديدة وتغييرات الحالة والمخزون عبر Server-Sent Events"""
+    async def event_stream():
+        queue = broker.subscribe()
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENT_HEARTBEAT_SECONDS)
+                    yield format_sse(event)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            broker.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/admin/inventory/stats")
+async def admin_inventory_stats(current_user=Depends(get_current_active_user)):
+    return ledger.stats()
+
+@app.get("/admin/db/coalescing")
+async def admin_db_coalescing(current_user=Depends(get_current_active_user)):
+    return db.get_coalescing_stats()
+
+@app.get("/admin/db/resilience")
+async def admin_db_resilience(current_user=Depends(get_current_active_user)):
+    return db.get_resilience_stats()
+
+@app.get("/admin/jobs/stats")
+async def admin_jobs_stats(current_user=Depends(get_current_active_user)):
+    return job_queue.stats()
+
+@app.get("/admin/jobs/dead")
+async def admin_jobs_dead(current_user=Depends(get_current_active_user)):
+    return {"jobs": list(job_queue.dead_letters)}
+
+@app.post("/admin/jobs/dead/{job_id}/retry")
+async def admin_jobs_retry(job_id: str, current_user=Depends(get_current_active_user)):
+    if not await job_queue.retry_dead(job_id):
+        raise HTTPException(status_code=404, detail="Not found")
+    return {"success": True}
+
+@app.get("/admin/ratelimit/stats")
+async def admin_ratelimit_stats(current_user=Depends(get_current_active_user)):
+    return rate_limiter.stats()
+
+@app.get("/admin/events/stats")
+async def admin_events_stats(current_user=Depends(get_current_active_user)):
+    return broker.stats()
+
 # ===== File Upload =====
 @app.post("/admin/upload", response_model=FileUploadResponse)
 async def upload_file(file: UploadFile = File(...), current_user=Depends(get_current_active_user)):
     try:
-        logger.info(f"Upload: {file.filename}")
+        logger.info("Upload: %s", file.filename)
         
         allowed_types = ['image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/jpg']
         if file.content_type not in allowed_types:
@@ -398,11 +1054,12 @@ async def upload_file(file: UploadFile = File(...), current_user=Depends(get_cur
         
         ext = file.filename.split('.')[-1].lower() if '.' in file.filename else 'jpg'
         unique_filename = f"{uuid.uuid4()}.{ext}"
+        key = shard_key(unique_filename)
         
         # محاولة Supabase أولاً
         if supabase_storage:
             try:
-                supabase_url = await upload_to_supabase(file_content, unique_filename, file.content_type)
+                supabase_url = await upload_to_supabase(file_content, key, file.content_type)
                 return {
                     "success": True,
                     "filename": unique_filename,
@@ -411,14 +1068,12 @@ async def upload_file(file: UploadFile = File(...), current_user=Depends(get_cur
                     "storage": "supabase"
                 }
             except Exception as e:
-                logger.warning(f"Supabase failed: {e}, trying local")
+                logger.warning("Supabase failed: %s, trying local", e)
         
         # التخزين المحلي كـ backup
-        file_path = UPLOAD_DIR / unique_filename
-        with open(file_path, "wb") as buffer:
-            buffer.write(file_content)
+        await asyncio.to_thread(media_store.write_local, unique_filename, file_content)
         
-        local_url = f"{BACKEND_PUBLIC_URL}/uploads/{unique_filename}"
+        local_url = f"{BACKEND_PUBLIC_URL}/uploads/{key}"
         return {
             "success": True,
             "filename": unique_filename,
@@ -430,13 +1085,76 @@ async def upload_file(file: UploadFile = File(...), current_user=Depends(get_cur
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Upload error: {e}")
+        logger.error("Upload error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/upload-simple", response_model=FileUploadResponse)
 async def upload_simple(file: UploadFile = File(...), current_user=Depends(get_current_active_user)):
     return await upload_file(file, current_user)
 
+# ===== Image Variants =====
+async def _load_image_source(filename: str) -> Optional[bytes]:
+    """قراءة الصورة الأصلية من uploads المحلي أو من Supabase Storage"""
+    local_path = media_store.local_path(filename)
+    if local_path.is_file():
+        return await asyncio.to_thread(local_path.read_bytes)
+    if supabase_storage:
+        # المسار الموزّع أولاً ثم المسار القديم المسطح
+        for key in (shard_key(filename), filename):
+            try:
+                return await asyncio.to_thread(supabase_storage.storage.from_(BUCKET_NAME).download, key)
+            except Exception as e:
+                logger.warning("Bucket download failed for %s: %s", key, e)
+    return None
+
+@app.get("/img/{filename}")
+async def get_image_variant(filename: str, w: int = 600, fmt: str = "webp"):
+    """نسخة مصغّرة من صورة منتج (تُبنى مرة واحدة وتُخزَّن على القرص)"""
+    if not image_resizer.available:
+        raise HTTPException(status_code=503, detail="Image processing is not available")
+    if Path(filename).name != filename or filename.startswith('.'):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    fmt = fmt.lower()
+    if fmt not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {fmt}")
+    if w <= 0:
+        raise HTTPException(status_code=400, detail="Invalid width")
+    try:
+        path, media_type = await image_resizer.get_variant(filename, snap_width(w), fmt, _load_image_source)
+    except ImageNotFound:
+        raise HTTPException(status_code=404, detail="Image not found")
+    except Exception as e:
+        logger.error("Image variant error for %s: %s", filename, e)
+        raise HTTPException(status_code=500, detail="Error")
+    return FileResponse(path, media_type=media_type, headers={
+        "Cache-Control": "public, max-age=31536000, immutable"
+    })
+
+@app.get("/admin/images/stats")
+async def image_stats(current_user=Depends(get_current_active_user)):
+    return image_resizer.stats()
+
+# ===== Media GC =====
+async def _load_media_refs():
+    return await db.get_media_references()
+
+@app.post("/admin/media/gc")
+async def run_media_gc(dry_run: bool = True, force: bool = False, current_user=Depends(get_current_active_user)):
+    """حذف الصور غير المستخدمة في أي منتج (dry_run للمعاينة، force لتجاوز حد نسبة اليتيمة)"""
+    try:
+        return await media_store.collect(_load_media_refs, dry_run=dry_run, force=force)
+    except MediaGCRefused as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except CircuitOpenError:
+        raise _service_unavailable()
+    except Exception as e:
+        logger.error("Media GC error: %s", e)
+        raise HTTPException(status_code=500, detail="Error")
+
+@app.get("/admin/media/stats")
+async def media_stats(current_user=Depends(get_current_active_user)):
+    return media_store.stats()
+
 # ===== Storage Tests =====
 @app.get("/admin/storage-status")
 async def storage_status(current_user=Depends(get_current_active_user)):
@@ -471,17 +1189,69 @@ async def get_dashboard_stats(current_user=Depends(get_current_active_user)):
             "total_orders": len(orders),
             "pending_orders": len([o for o in orders if o.get('status') == 'pending']),
             "total_revenue": sum(o.get('total_amount', 0) for o in orders if o.get('status') in ['confirmed', 'shipped', 'delivered']),
-            "low_stock_products": len([p for p in products if p.get('stock_quantity', 0) < 5])
+            "low_stock_products": len([p for p in products if p.get('stock_quantity', 0) < LOW_STOCK_THRESHOLD])
         }
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Stats error: {e}")
+        logger.error("Stats error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
+# ===== Analytics =====
+async def _backfill_analytics():
+    """إعادة بناء التجميعات من كل الطلبات (مسح واحد للجدولين)"""
+    orders = await db.get_all_orders()
+    order_items = await db.get_all_order_items()
+    rollups.backfill(orders, order_items)
+
+async def _build_indexes():
+    """بناء الفهارس في الذاكرة عند التشغيل (مسح واحد لكل جدول)"""
+    try:
+        orders = await db.get_all_orders()
+        order_items = await db.get_all_order_items()
+        products = await db.get_all_products()
+        rollups.backfill(orders, order_items)
+        co_purchases.build(order_items, products)
+        facet_index.build([ledger.apply(dict(p)) for p in products])
+        snapshot_builder.schedule()
+    except Exception as e:
+        logger.error("Index build error: %s", e)
+
+@app.post("/admin/analytics/backfill")
+async def analytics_backfill(current_user=Depends(get_current_active_user)):
+    try:
+        await _backfill_analytics()
+        return {"success": True, "backfilled_at": rollups.backfilled_at}
+    except CircuitOpenError:
+        raise _service_unavailable()
+    except Exception as e:
+        logger.error("Analytics backfill error: %s", e)
+        raise HTTPException(status_code=500, detail="Error")
+
+@app.get("/admin/analytics/daily")
+async def analytics_daily(days: int = 30, current_user=Depends(get_current_active_user)):
+    return {"days": rollups.daily_series(max(1, min(days, 366)))}
+
+@app.get("/admin/analytics/monthly")
+async def analytics_monthly(months: int = 12, current_user=Depends(get_current_active_user)):
+    return {"months": rollups.monthly_series(max(1, min(months, 60)))}
+
+@app.get("/admin/analytics/top-products")
+async def analytics_top_products(limit: int = 10, by: str = "units", current_user=Depends(get_current_active_user)):
+    if by not in ("units", "revenue"):
+        raise HTTPException(status_code=400, detail="by must be units or revenue")
+    return {"products": rollups.top_products(max(1, min(limit, 100)), by)}
+
+@app.get("/admin/analytics/categories")
+async def analytics_categories(current_user=Depends(get_current_active_user)):
+    return {"categories": rollups.category_breakdown()}
+
 # ===== Search & Categories =====
 @app.get("/search")
-async def search_products(q: str, limit: int = 20):
+async def search_products(q: str, limit: int = 20, fields: Optional[str] = None):
+    requested = _parse_fields(fields, PRODUCT_FIELDS)
     try:
-        products = await db.get_all_products()
+        products = await db.get_all_products(_select_columns(requested, 'name', 'description', 'category'))
         search_lower = q.lower()
         
         filtered = [p for p in products if 
@@ -490,9 +1260,13 @@ async def search_products(q: str, limit: int = 20):
             search_lower in p.get('category', '').lower()
         ]
         
+        if requested:
+            return [_project(dict(p), requested) for p in filtered[:limit]]
         return filtered[:limit]
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Search error: {e}")
+        logger.error("Search error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
 @app.get("/categories")
@@ -501,8 +1275,10 @@ async def get_categories():
         products = await db.get_all_products()
         categories = list(set(p.get('category', '') for p in products if p.get('category')))
         return {"categories": sorted(categories)}
+    except CircuitOpenError:
+        raise _service_unavailable()
     except Exception as e:
-        logger.error(f"Categories error: {e}")
+        logger.error("Categories error: %s", e)
         raise HTTPException(status_code=500, detail="Error")
 
 # ===== Error Handlers =====
@@ -510,12 +1286,17 @@ async def get_categories():
 async def http_exception_handler(request, exc):
     return JSONResponse(
         status_code=exc.status_code,
-        content={"success": False, "message": exc.detail}
+        content={"success": False, "message": exc.detail},
+        headers=getattr(exc, "headers", None)
     )
 
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request, exc):
+    return await http_exception_handler(request, _service_unavailable())
+
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
-    logger.error(f"Unhandled: {exc}")
+    logger.error("Unhandled: %s", exc, exc_info=exc)
     return JSONResponse(
         status_code=500,
         content={"success": False, "message": "Internal error"}
@@ -527,7 +1308,7 @@ try:
     if static_dir.exists():
         app.mount("/static", StaticFiles(directory="backend/static/static"), name="static_files")
 except Exception as e:
-    logger.warning(f"Static mount failed: {e}")
+    logger.warning("Static mount failed: %s", e)
 
 @app.get("/favicon.ico")
 async def favicon():
@@ -552,10 +1333,10 @@ async def serve_spa(path_name: str):
     """
     # قائمة مسارات API الفعلية فقط (بدون /admin لأنه صفحة React)
     api_only_prefixes = [
-        "docs", "openapi.json", "redoc", "health", "status", 
+        "docs", "openapi.json", "redoc", "health", "status", "metrics", 
         "auth/login", "admin/login", "admin/me", "admin/products", 
-        "admin/orders", "admin/upload", "admin/storage-status", "admin/dashboard",
-        "products/", "orders", "upload", "search", "categories", "api"
+        "admin/orders", "admin/upload", "admin/storage-status", "admin/dashboard", "admin/events", "admin/inventory", "admin/db", "admin/analytics", "admin/images", "admin/recommendations", "admin/catalog", "admin/jobs", "admin/ratelimit", "admin/media",
+        "products/", "orders", "cart", "upload", "search", "categories", "catalog", "img/", "snapshots", "api"
     ]
     
     # تحقق إذا كان المسار API endpoint حقيقي
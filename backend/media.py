@@ -0,0 +1,233 @@
+"""
+دورة حياة الصور المرفوعة: تخزين موزّع على مجلدات حسب بادئة الـ hash وجمع الصور اليتيمة (mark-and-sweep)
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+from urllib.parse import urlparse
+
+from resilience import track_stale
+
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "uploads"))
+# لا تُحذف الملفات الأحدث من هذه المدة (رفع صورة قبل حفظ المنتج)
+MEDIA_GC_GRACE_SECONDS = float(os.getenv("MEDIA_GC_GRACE_SECONDS", str(24 * 3600)))
+MEDIA_GC_INTERVAL_SECONDS = float(os.getenv("MEDIA_GC_INTERVAL_SECONDS", str(6 * 3600)))
+# الـ GC الدوري معطل افتراضياً، وعند تفعيله يعاين فقط حتى MEDIA_GC_DRY_RUN=false
+MEDIA_GC_ENABLED = os.getenv("MEDIA_GC_ENABLED", "false").lower() == "true"
+MEDIA_GC_DRY_RUN = os.getenv("MEDIA_GC_DRY_RUN", "true").lower() == "true"
+# رفض الحذف إذا كانت نسبة الملفات اليتيمة أعلى من هذا (قراءة ناقصة للكتالوج غالباً)
+MEDIA_GC_MAX_ORPHAN_RATIO = float(os.getenv("MEDIA_GC_MAX_ORPHAN_RATIO", "0.5"))
+BUCKET_PAGE_SIZE = 1000
+# ملفات لا يجمعها الـ GC أبداً
+MEDIA_KEEP_NAMES = {".gitkeep", ".emptyFolderPlaceholder"}
+
+logger = logging.getLogger(__name__)
+
+
+class MediaGCRefused(Exception):
+    """الـ GC رفض الحذف لأن قائمة المراجع غير موثوقة"""
+
+
+def shard_key(filename: str) -> str:
+    """المسار داخل uploads والـ bucket: <أول حرفين من sha1>/<filename>"""
+    return f"{hashlib.sha1(filename.encode('utf-8')).hexdigest()[:2]}/{filename}"
+
+
+def _is_shard(name: str) -> bool:
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+
+def referenced_files(products: list) -> set:
+    """أسماء الملفات المستخدمة في image_url و images لكل المنتجات"""
+    names = set()
+    for product in products:
+        urls = [product.get('image_url')] + list(product.get('images') or [])
+        for url in urls:
+            if isinstance(url, str) and url:
+                name = PurePosixPath(urlparse(url).path).name
+                if name:
+                    names.add(name)
+    return names
+
+
+def _bucket_time(entry: dict) -> float:
+    stamp = entry.get('created_at') or entry.get('updated_at')
+    if not stamp:
+        return time.time()  # بدون تاريخ: يُعامل كجديد ولا يُحذف
+    return datetime.fromisoformat(stamp.replace('Z', '+00:00')).timestamp()
+
+
+class MediaStore:
+    def __init__(self, upload_dir: Path = UPLOAD_DIR, grace_seconds: float = MEDIA_GC_GRACE_SECONDS):
+        self.upload_dir = upload_dir
+        self.grace_seconds = grace_seconds
+        self.bucket = None  # Supabase storage bucket (يُضبط من main)
+        self.runs = 0
+        self.reclaimed_bytes = 0
+        self.deleted_files = 0
+        self.last_report = None
+        self._lock = asyncio.Lock()
+
+    # ===== Layout =====
+    def local_path(self, filename: str) -> Path:
+        """مسار الملف الموزّع، أو المسار القديم المسطح إذا كان الملف هناك"""
+        path = self.upload_dir / shard_key(filename)
+        if not path.exists():
+            legacy = self.upload_dir / filename
+            if legacy.exists():
+                return legacy
+        return path
+
+    def write_local(self, filename: str, data: bytes) -> str:
+        """حفظ ملف في مجلده الموزّع، يعيد المفتاح النسبي (آمنة للتشغيل في thread)"""
+        key = shard_key(filename)
+        path = self.upload_dir / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        return key
+
+    # ===== Sweep =====
+    def _scan_local(self, referenced: set, cutoff: float):
+        """(عدد الملفات، الملفات اليتيمة الأقدم من فترة السماح [(path, size)])"""
+        total, orphans = 0, []
+        for path in self.upload_dir.rglob('*'):
+            if not path.is_file() or path.name in MEDIA_KEEP_NAMES:
+                continue
+            total += 1
+            if path.name in referenced:
+                continue
+            stat = path.stat()
+            if stat.st_mtime <= cutoff:
+                orphans.append((path, stat.st_size))
+        return total, orphans
+
+    def _delete_local(self, orphans: list):
+        for path, _ in orphans:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _list_bucket(self, prefix: str = "") -> list:
+        entries = []
+        offset = 0
+        while True:
+            page = self.bucket.list(prefix, {"limit": BUCKET_PAGE_SIZE, "offset": offset}) or []
+            entries.extend(page)
+            if len(page) < BUCKET_PAGE_SIZE:
+                return entries
+            offset += BUCKET_PAGE_SIZE
+
+    def _scan_bucket(self, referenced: set, cutoff: float):
+        objects = []
+        for entry in self._list_bucket():
+            if entry.get('id') is None:
+                # مجلد: فقط مجلدات التوزيع الخاصة بنا
+                if _is_shard(entry['name']):
+                    objects.extend((f"{entry['name']}/{e['name']}", e)
+                                   for e in self._list_bucket(entry['name']) if e.get('id') is not None)
+            else:
+                objects.append((entry['name'], entry))
+
+        total, orphans = 0, []
+        for key, entry in objects:
+            name = PurePosixPath(key).name
+            if name in MEDIA_KEEP_NAMES:
+                continue
+            total += 1
+            if name in referenced or _bucket_time(entry) > cutoff:
+                continue
+            orphans.append((key, (entry.get('metadata') or {}).get('size') or 0))
+        return total, orphans
+
+    def _delete_bucket(self, orphans: list):
+        keys = [key for key, _ in orphans]
+        for i in range(0, len(keys), BUCKET_PAGE_SIZE):
+            self.bucket.remove(keys[i:i + BUCKET_PAGE_SIZE])
+
+    async def collect(self, load_products, dry_run: bool = True, force: bool = False) -> dict:
+        """
+        Mark: أسماء الملفات المستخدمة من كل المنتجات. Sweep: حذف غير المستخدم
+        الأقدم من فترة السماح محلياً وفي الـ bucket. يرفض الحذف إذا كانت القراءة
+        قديمة أو فارغة، أو إذا تجاوزت نسبة اليتيمة MEDIA_GC_MAX_ORPHAN_RATIO (إلا مع force).
+        """
+        async with self._lock:
+            started = time.monotonic()
+            stale = track_stale()
+            referenced = referenced_files(await load_products())
+            if stale:
+                raise MediaGCRefused("Product catalog is stale, skipping media sweep")
+            if not referenced:
+                raise MediaGCRefused("No product references any image, refusing to sweep")
+            cutoff = time.time() - self.grace_seconds
+
+            local_total, local_orphans = await asyncio.to_thread(self._scan_local, referenced, cutoff)
+            bucket_total, bucket_orphans = 0, []
+            if self.bucket is not None:
+                bucket_total, bucket_orphans = await asyncio.to_thread(self._scan_bucket, referenced, cutoff)
+
+            total = local_total + bucket_total
+            orphan_count = len(local_orphans) + len(bucket_orphans)
+            ratio = orphan_count / total if total else 0.0
+            report = {
+                "dry_run": dry_run,
+                "referenced": len(referenced),
+                "scanned": total,
+                "orphan_ratio": round(ratio, 3),
+                "local": {"deleted": len(local_orphans), "bytes": sum(size for _, size in local_orphans)},
+                "bucket": ({"deleted": len(bucket_orphans), "bytes": sum(size for _, size in bucket_orphans)}
+                           if self.bucket is not None else None),
+                "refused": None
+            }
+            if not dry_run and ratio > MEDIA_GC_MAX_ORPHAN_RATIO and not force:
+                report["refused"] = (f"Orphan ratio {ratio:.0%} exceeds "
+                                     f"MEDIA_GC_MAX_ORPHAN_RATIO {MEDIA_GC_MAX_ORPHAN_RATIO:.0%}")
+                dry_run = report["dry_run"] = True
+                logger.warning("Media GC refused: %s", report["refused"])
+
+            if not dry_run:
+                await asyncio.to_thread(self._delete_local, local_orphans)
+                if bucket_orphans:
+                    await asyncio.to_thread(self._delete_bucket, bucket_orphans)
+
+            parts = [report["local"]] + ([report["bucket"]] if report["bucket"] else [])
+            report["deleted"] = sum(p["deleted"] for p in parts)
+            report["reclaimed_bytes"] = sum(p["bytes"] for p in parts)
+            report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            report["finished_at"] = datetime.utcnow()
+
+            if not dry_run:
+                self.runs += 1
+                self.deleted_files += report["deleted"]
+                self.reclaimed_bytes += report["reclaimed_bytes"]
+            self.last_report = report
+            logger.info("Media GC: %s orphans, %s bytes reclaimable (dry_run=%s)",
+                        report["deleted"], report["reclaimed_bytes"], dry_run)
+            return report
+
+    async def run_collector(self, load_products, interval: float = MEDIA_GC_INTERVAL_SECONDS):
+        """حلقة خلفية للـ GC الدوري (معاينة فقط ما لم يكن MEDIA_GC_DRY_RUN=false)"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.collect(load_products, dry_run=MEDIA_GC_DRY_RUN)
+            except Exception as e:
+                logger.error("Media GC error: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "deleted_files": self.deleted_files,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "grace_seconds": self.grace_seconds,
+            "bucket_configured": self.bucket is not None,
+            "last_report": self.last_report
+        }
+
+
+# إنشاء instance مشترك
+media_store = MediaStore()
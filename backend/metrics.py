@@ -0,0 +1,174 @@
+"""
+قياسات الأداء (مسارات API، استعلامات قاعدة البيانات، رفع الملفات) بصيغة Prometheus
+"""
+import bisect
+import functools
+import logging
+import os
+import time
+
+# الاستعلامات الأبطأ من هذا الحد تُسجَّل في اللوق (0 للتعطيل)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, total in self._values.items():
+            lines.append(f"{self.name}{_labels(self.labels, values)} {total}")
+        return lines
+
+
+class Gauge:
+    """قيمة لحظية تُقرأ من دالة عند كل طلب /metrics"""
+
+    def __init__(self, name: str, help_text: str, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self) -> list:
+        try:
+            value = self.callback()
+        except Exception as e:
+            logger.error("Gauge %s failed: %s", self.name, e)
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf], sum
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _labels(self.labels, values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            cumulative += counts[-1]
+            le = _labels(self.labels, values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, values)} {cumulative}")
+        return lines
+
+
+def render_metrics() -> str:
+    """كل القياسات بصيغة Prometheus text exposition"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# ===== Metrics =====
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status"))
+DB_LATENCY = Histogram("db_query_duration_seconds", "DatabaseService call latency", ("method",))
+DB_ROWS = Counter("db_query_rows_total", "Rows returned by DatabaseService calls", ("method",))
+DB_ERRORS = Counter("db_query_errors_total", "Failed DatabaseService calls", ("method",))
+DB_SLOW = Counter("db_slow_queries_total", "DatabaseService calls slower than SLOW_QUERY_MS", ("method",))
+STORAGE_LATENCY = Histogram("storage_upload_duration_seconds", "Supabase Storage upload latency", ("outcome",))
+STORAGE_BYTES = Counter("storage_upload_bytes_total", "Bytes uploaded to Supabase Storage")
+
+
+def _row_count(result) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def timed_query(func):
+    """قياس زمن وعدد صفوف كل استدعاء لدالة في DatabaseService"""
+    method = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(method)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            DB_LATENCY.observe(elapsed, method)
+            if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+                DB_SLOW.inc(method)
+                logger.warning("Slow query %s took %.1f ms", method, elapsed * 1000)
+        DB_ROWS.inc(method, amount=_row_count(result))
+        return result
+
+    return wrapper
+
+
+class TimingMiddleware:
+    """Middleware ASGI لقياس زمن كل طلب حسب اسم الـ endpoint"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            endpoint = scope.get("endpoint")
+            route = getattr(endpoint, "__name__", "unmatched")
+            HTTP_LATENCY.observe(time.perf_counter() - start, scope.get("method", ""), route, status_code)
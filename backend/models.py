@@ -110,6 +110,24 @@ class Order(OrderBase):
 
     model_config = ConfigDict(from_attributes=True)
 
+# ===== Cart Models =====
+class CartQuoteRequest(BaseModel):
+    items: List[OrderItemCreate]
+
+class CartQuoteLine(BaseModel):
+    product_id: int
+    quantity: int
+    product: Optional[Product] = None
+    price_per_unit: Optional[float] = None
+    total_price: float = 0
+    available_quantity: int = 0
+    warning: Optional[str] = None  # not_found | unavailable | out_of_stock | insufficient_stock
+
+class CartQuote(BaseModel):
+    items: List[CartQuoteLine]
+    total_amount: float
+    can_checkout: bool
+
 # ===== Auth Models =====
 class Token(BaseModel):
     access_token: str
@@ -154,6 +172,21 @@ class FileUploadResponse(BaseModel):
     url: str
     size: int
 
+class BulkProductResult(BaseModel):
+    row: int
+    success: bool
+    action: Optional[str] = None  # created | updated
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+class BulkProductResponse(BaseModel):
+    success: bool
+    total: int
+    created: int
+    updated: int
+    failed: int
+    results: List[BulkProductResult]
+
 class DashboardStats(BaseModel):
     total_products: int
     total_orders: int
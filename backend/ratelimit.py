@@ -0,0 +1,189 @@
+"""
+تحديد معدل الطلبات (token bucket لكل IP ومسار) وإسقاط الحمل عند تجاوز حد الطلبات الجارية
+"""
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+# الصيغة: "METHOD /path=capacity/seconds,..." مثال: "POST /orders=10/60"
+RATE_LIMITS = os.getenv(
+    "RATE_LIMITS",
+    "POST /orders=10/60,GET /search=60/60,GET /products=120/60,GET /catalog=120/60,"
+    "POST /cart/quote=60/60,POST /admin/login=5/60,POST /auth/login=5/60"
+)
+MAX_INFLIGHT_REQUESTS = int(os.getenv("MAX_INFLIGHT_REQUESTS", "200"))
+# خلف بروكسي بعناوين متغيرة (Railway): TRUST_PROXY_HEADERS=true ويُؤخذ العنوان الذي أضافه
+# أقرب بروكسي موثوق (TRUSTED_PROXY_HOPS من اليمين) لأن بداية الهيدر يتحكم بها العميل.
+# لا تستخدم FORWARDED_ALLOW_IPS="*" مع --proxy-headers: يأخذ uvicorn حينها أول عنوان في الهيدر.
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "false").lower() == "true"
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "50000"))
+# مسارات لا تخضع لإسقاط الحمل (فحص الصحة، القياسات، البث الطويل)
+SHED_EXEMPT_PATHS = ("/health", "/metrics", "/admin/events")
+
+
+def parse_limits(spec: str) -> dict:
+    """تحويل RATE_LIMITS إلى {(method, path): (capacity, refill_per_second)}"""
+    limits = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        route, budget = entry.rsplit('=', 1)
+        method, path = route.split(None, 1)
+        capacity, seconds = budget.split('/')
+        limits[(method.upper(), path.strip())] = (float(capacity), float(capacity) / float(seconds))
+    return limits
+
+
+class TokenBucket:
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        """يعيد 0 عند السماح، أو عدد الثواني حتى يتوفر token"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    def __init__(self, limits: dict = None, max_inflight: int = MAX_INFLIGHT_REQUESTS):
+        self.limits = limits if limits is not None else parse_limits(RATE_LIMITS)
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self._buckets = OrderedDict()  # (ip, method, path) -> TokenBucket، الأقدم استخداماً أولاً
+        self.allowed = 0
+        self.limited = {}   # "METHOD /path" -> count
+        self.shed = 0
+        self.evicted = 0
+
+    def check(self, client_ip: str, method: str, path: str) -> float:
+        """0 إذا سُمح بالطلب، وإلا ثواني الانتظار"""
+        limit = self.limits.get((method, path))
+        if limit is None:
+            return 0.0
+        key = (client_ip, method, path)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= RATE_LIMIT_MAX_BUCKETS:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(*limit)
+        else:
+            self._buckets.move_to_end(key)
+        wait = bucket.take()
+        if wait:
+            route = f"{method} {path}"
+            self.limited[route] = self.limited.get(route, 0) + 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def _prune(self):
+        """
+        حذف الـ buckets الممتلئة (عملاء خاملون)، ثم الأقدم استخداماً حتى 90% من الحد
+        كي لا تتجاوز العناوين المزيفة الكثيرة RATE_LIMIT_MAX_BUCKETS
+        """
+        now = time.monotonic()
+        for key in [k for k, b in self._buckets.items() if b.is_full(now)]:
+            del self._buckets[key]
+        while len(self._buckets) > RATE_LIMIT_MAX_BUCKETS * 0.9:
+            self._buckets.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "buckets": len(self._buckets),
+            "allowed": self.allowed,
+            "limited": dict(self.limited),
+            "shed": self.shed,
+            "evicted": self.evicted,
+            "limits": {f"{m} {p}": {"capacity": c, "per_second": round(r, 4)}
+                       for (m, p), (c, r) in self.limits.items()}
+        }
+
+
+def _client_ip(scope) -> str:
+    if TRUST_PROXY_HEADERS:
+        for key, value in scope.get("headers", []):
+            if key == b"x-forwarded-for":
+                hops = [hop.strip() for hop in value.decode('latin-1').split(',') if hop.strip()]
+                if hops:
+                    return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+async def _reject(send, status_code: int, message: str, retry_after: float):
+    body = json.dumps({"success": False, "message": message}).encode('utf-8')
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode('latin-1')),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode('latin-1')),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class RateLimitMiddleware:
+    """Middleware ASGI: 429 عند نفاد الـ tokens و 503 عند تجاوز MAX_INFLIGHT_REQUESTS"""
+
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope.get("path", "")
+        if path == "/api" or path.startswith("/api/"):
+            path = path[4:] or "/"
+        method = scope.get("method", "GET")
+
+        wait = self.limiter.check(_client_ip(scope), method, path)
+        if wait:
+            await _reject(send, 429, "Too many requests", wait)
+            return
+
+        exempt = path.startswith(SHED_EXEMPT_PATHS)
+        if not exempt and self.limiter.inflight >= self.limiter.max_inflight:
+            self.limiter.shed += 1
+            await _reject(send, 503, "Server busy", 1)
+            return
+
+        if exempt:
+            await self.app(scope, receive, send)
+            return
+        self.limiter.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.inflight -= 1
+
+
+# إنشاء instance مشترك
+rate_limiter = RateLimiter()
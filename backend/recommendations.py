@@ -0,0 +1,123 @@
+"""
+توصيات "يُشترى معاً غالباً" من مصفوفة تكرار مشتركة (sparse) تُحدَّث مع كل طلب
+"""
+import heapq
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+
+RELATED_CACHE_SIZE = int(os.getenv("RELATED_CACHE_SIZE", "20"))
+
+logger = logging.getLogger(__name__)
+
+
+class CoOccurrenceIndex:
+    def __init__(self):
+        self._pairs = {}           # product_id -> Counter(other_id -> عدد الطلبات المشتركة)
+        self._categories = {}      # product_id -> category
+        self._by_category = {}     # category -> set(product_id) للمنتجات المتاحة
+        self._available = set()    # المنتجات المتاحة للبيع
+        self._top = {}             # product_id -> أعلى RELATED_CACHE_SIZE (يُلغى عند التحديث)
+        self.orders_indexed = 0
+        self.built_at = None
+
+    # ===== Build =====
+    def build(self, order_items: list, products: list):
+        """بناء المصفوفة من كل order_items التاريخية والفئات من الكتالوج"""
+        self._pairs = {}
+        self._top = {}
+        self._categories = {}
+        self._by_category = {}
+        self._available = set()
+        for product in products:
+            self.set_product(product)
+
+        baskets = {}
+        for item in order_items:
+            baskets.setdefault(item['order_id'], set()).add(item['product_id'])
+        self.orders_indexed = 0
+        for product_ids in baskets.values():
+            self.record_order(product_ids)
+        self.built_at = datetime.utcnow()
+        logger.info("Co-occurrence index built from %s orders", len(baskets))
+
+    # ===== Incremental Updates =====
+    def record_order(self, product_ids):
+        """إضافة سلة طلب واحد (كل زوج مختلف يزيد بواحد)"""
+        basket = set(product_ids)
+        self.orders_indexed += 1
+        if len(basket) < 2:
+            return
+        for pid in basket:
+            counts = self._pairs.setdefault(pid, Counter())
+            for other in basket:
+                if other != pid:
+                    counts[other] += 1
+            self._top.pop(pid, None)
+
+    def set_product(self, product: dict):
+        """تحديث فئة وتوفر منتج (من الكتالوج أو بعد تعديل الادمن)"""
+        pid = product.get('id')
+        if pid is None:
+            return
+        self._discard_category(pid)
+        category = product.get('category')
+        self._categories[pid] = category
+        if product.get('is_available', True):
+            self._available.add(pid)
+            if category:
+                self._by_category.setdefault(category, set()).add(pid)
+        else:
+            self._available.discard(pid)
+
+    def remove_product(self, product_id: int):
+        self._discard_category(product_id)
+        self._categories.pop(product_id, None)
+        self._available.discard(product_id)
+        self._pairs.pop(product_id, None)
+        self._top.pop(product_id, None)
+
+    def _discard_category(self, product_id: int):
+        previous = self._categories.get(product_id)
+        if previous in self._by_category:
+            self._by_category[previous].discard(product_id)
+
+    # ===== Reads =====
+    def knows(self, product_id: int) -> bool:
+        """المنتج موجود في الكتالوج المفهرس"""
+        return product_id in self._categories
+
+    def related(self, product_id: int, limit: int) -> list:
+        """أعلى المنتجات المتاحة المشتركة مع درجة كل منها، ثم منتجات من نفس الفئة"""
+        top = self._top.get(product_id)
+        if top is None:
+            counts = self._pairs.get(product_id)
+            top = heapq.nlargest(RELATED_CACHE_SIZE, counts.items(), key=lambda kv: kv[1]) if counts else []
+            # الكاش فقط لمنتجات معروفة لها أزواج، حتى لا تُضخّمه معرفات عشوائية
+            if counts and self.knows(product_id):
+                self._top[product_id] = top
+
+        results = [{'product_id': pid, 'score': count, 'source': 'co_purchase'}
+                   for pid, count in top if pid in self._available][:limit]
+        if len(results) < limit:
+            seen = {product_id, *(r['product_id'] for r in results)}
+            category = self._categories.get(product_id)
+            for pid in sorted(self._by_category.get(category, ())):
+                if pid not in seen:
+                    results.append({'product_id': pid, 'score': 0, 'source': 'category'})
+                    if len(results) >= limit:
+                        break
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "products_with_pairs": len(self._pairs),
+            "pairs": sum(len(c) for c in self._pairs.values()),
+            "orders_indexed": self.orders_indexed,
+            "built_at": self.built_at
+        }
+
+
+# إنشاء instance مشترك
+co_purchases = CoOccurrenceIndex()
@@ -0,0 +1,221 @@
+"""
+حماية الاستدعاءات إلى Supabase: مهلة لكل استدعاء، قاطع دائرة، ميزانية إعادة محاولة،
+وتعليم الاستجابات التي تُخدم من بيانات قديمة (last-known-good)
+"""
+import asyncio
+import logging
+import os
+import time
+from contextvars import ContextVar
+
+DB_TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", "5"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+# نسبة إعادة المحاولات المسموحة مقارنة بعدد الاستدعاءات
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MAX = float(os.getenv("RETRY_BUDGET_MAX", "10"))
+# أقصى عمر للبيانات القديمة التي يمكن خدمتها أثناء الأعطال
+STALE_MAX_AGE_SECONDS = float(os.getenv("STALE_MAX_AGE_SECONDS", "86400"))
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """القاطع مفتوح: الاستدعاء رُفض فوراً بدون الوصول لـ Supabase"""
+
+
+# SQLSTATE classes: اتصال، موارد، إيقاف/مهلة، أخطاء النظام
+TRANSIENT_SQLSTATE_PREFIXES = ("08", "53", "57", "58", "XX")
+# أخطاء PostgREST عند تعذر الاتصال بقاعدة البيانات
+TRANSIENT_PGRST_CODES = {"PGRST000", "PGRST001", "PGRST002", "PGRST003"}
+
+
+def is_transient(error: Exception) -> bool:
+    """أخطاء عابرة فقط (مهلة، نقل، 5xx) تُحتسب على القاطع ويُعاد عليها المحاولة"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if type(error).__module__.startswith(("httpx", "httpcore")):
+        # أخطاء النقل (ConnectError, ReadTimeout, RemoteProtocolError ...)
+        response = getattr(error, "response", None)
+        return response is None or response.status_code >= 500
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if isinstance(status, int):
+        return status >= 500
+    code = getattr(error, "code", None)
+    if code is None:
+        return False
+    code = str(code)
+    if code.isdigit() and len(code) == 3:
+        # APIError بدون JSON يحمل رمز HTTP
+        return int(code) >= 500
+    return code in TRANSIENT_PGRST_CODES or code.startswith(TRANSIENT_SQLSTATE_PREFIXES)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_inflight = False
+        self.rejected = 0
+
+    def before_call(self):
+        """يرفع CircuitOpenError إذا كان يجب رفض الاستدعاء"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                self.rejected += 1
+                raise CircuitOpenError("Supabase circuit is open")
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            # استدعاء تجريبي واحد فقط في كل مرة
+            if self._probe_inflight:
+                self.rejected += 1
+                raise CircuitOpenError("Supabase circuit is half-open")
+            self._probe_inflight = True
+
+    def release_probe(self):
+        """السماح باستدعاء تجريبي جديد (حتى لو أُلغي الاستدعاء السابق)"""
+        self._probe_inflight = False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Supabase circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_inflight = False
+
+    def record_failure(self):
+        self._probe_inflight = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Supabase circuit opened after %s failures", self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """كل استدعاء يضيف RETRY_BUDGET_RATIO رصيداً، وكل إعادة محاولة تستهلك 1"""
+
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, maximum: float = RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.balance = maximum
+
+    def deposit(self):
+        self.balance = min(self.balance + self.ratio, self.maximum)
+
+    def try_withdraw(self) -> bool:
+        if self.balance >= 1:
+            self.balance -= 1
+            return True
+        return False
+
+
+class ResilientExecutor:
+    def __init__(self, timeout: float = DB_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+        self.timeouts = 0
+        self.retries = 0
+
+    async def run(self, fn, retry: bool = False):
+        """تشغيل استدعاء Supabase المتزامن في thread مع مهلة وقاطع دائرة
+
+        عند انتهاء المهلة يبقى الـ thread يعمل حتى يعيد العميل، لكن المستدعي
+        لا ينتظره. إعادة المحاولة للقراءات فقط، للأخطاء العابرة، وبحدود الميزانية.
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = await asyncio.wait_for(asyncio.to_thread(fn), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self.breaker.record_failure()
+                error = TimeoutError(f"Supabase call exceeded {self.timeout}s")
+            except Exception as e:
+                if not is_transient(e):
+                    # Supabase استجاب: الخطأ من الطلب نفسه (4xx، قيود، أعمدة)
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                error = e
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                # CancelledError لا يمر بـ except Exception
+                self.breaker.release_probe()
+
+            attempt += 1
+            if not retry or attempt > 1 or self.breaker.state == CircuitBreaker.OPEN or not self.budget.try_withdraw():
+                raise error
+            self.retries += 1
+
+    def stats(self) -> dict:
+        return {
+            "breaker_state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "rejected": self.breaker.rejected,
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "retry_budget": round(self.budget.balance, 2)
+        }
+
+
+# ===== Stale Responses =====
+_stale_marker = ContextVar("stale_marker", default=None)
+
+
+def mark_stale(age_seconds: float):
+    """تعليم الطلب الحالي بأنه خُدم من بيانات قديمة"""
+    marker = _stale_marker.get()
+    if marker is not None:
+        marker['age'] = max(marker.get('age', 0), age_seconds)
+
+
+def track_stale() -> dict:
+    """تتبع القراءات القديمة في المهمة الحالية (خارج الطلبات)، يعيد dict يمتلئ عند القراءة القديمة"""
+    marker = {}
+    _stale_marker.set(marker)
+    return marker
+
+
+class StaleHeaderMiddleware:
+    """Middleware ASGI يضيف هيدرات Age و Warning للاستجابات المبنية على بيانات قديمة"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # dict مشترك حتى تراه المهام الفرعية (BaseHTTPMiddleware ينسخ الـ context)
+        marker = {}
+        token = _stale_marker.set(marker)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and marker:
+                headers = list(message.get("headers", []))
+                headers.append((b"age", str(int(marker['age'])).encode('latin-1')))
+                headers.append((b"warning", b'110 - "Response is Stale"'))
+                headers.append((b"x-data-stale", b"true"))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _stale_marker.reset(token)
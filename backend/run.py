@@ -19,5 +19,8 @@ if __name__ == "__main__":
         "main:app",
         host="0.0.0.0",
         port=port,
-        log_level="info"
+        log_level="info",
+        # عنوان العميل الحقيقي خلف بروكسي بعنوان ثابت (لا تستخدم "*": يأخذ uvicorn حينها أول عنوان يرسله العميل)
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
     )
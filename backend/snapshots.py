@@ -0,0 +1,222 @@
+"""
+لقطات الكتالوج: ملفات JSON مُصدَّرة مسبقاً (مع gzip/brotli) لكل إصدار، وملف مؤشر للإصدار الحالي
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from datetime import datetime
+from pathlib import Path
+
+from compression import brotli, choose_encoding
+
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR", "catalog_snapshots"))
+# إعادة البناء بعد هدوء الكتابات لهذه المدة، وبحد أقصى SNAPSHOT_MAX_DELAY_SECONDS من أول تغيير
+SNAPSHOT_DEBOUNCE_SECONDS = float(os.getenv("SNAPSHOT_DEBOUNCE_SECONDS", "2"))
+SNAPSHOT_MAX_DELAY_SECONDS = float(os.getenv("SNAPSHOT_MAX_DELAY_SECONDS", "30"))
+# إصدارات قديمة تبقى على القرص للعملاء الذين قرؤوا مؤشراً سابقاً
+SNAPSHOT_KEEP_VERSIONS = int(os.getenv("SNAPSHOT_KEEP_VERSIONS", "3"))
+POINTER_FILE = "current.json"
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+logger = logging.getLogger(__name__)
+
+
+def slugify(value: str) -> str:
+    slug = re.sub(r'[^a-z0-9؀-ۿ]+', '-', value.lower()).strip('-')
+    return slug or hashlib.sha1(value.encode('utf-8')).hexdigest()[:8]
+
+
+def _write_version(directory: Path, documents: dict):
+    """كتابة ملفات إصدار كامل في مجلد مؤقت ثم نقله (آمنة للتشغيل في thread)"""
+    tmp = directory.with_name(directory.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name, body in documents.items():
+        (tmp / name).write_bytes(body)
+        (tmp / (name + '.gz')).write_bytes(gzip.compress(body, compresslevel=9))
+        if brotli is not None:
+            (tmp / (name + '.br')).write_bytes(brotli.compress(body, quality=11))
+    shutil.rmtree(directory, ignore_errors=True)
+    tmp.replace(directory)
+
+
+class SnapshotBuilder:
+    def __init__(self, directory: Path = SNAPSHOT_DIR):
+        self.directory = directory
+        self.render = None          # async () -> {name: payload}، يُضبط من main
+        self.version = None
+        self.files = []             # أسماء ملفات الإصدار الحالي
+        self.built_at = None
+        self.builds = 0
+        self.skipped = 0            # بناء بنفس المحتوى (لا إصدار جديد)
+        self.triggers = 0
+        self._first_change = None
+        self._last_change = None
+        self._task = None
+        self._current = {}          # (name, encoding) -> bytes للإصدار الحالي
+        self._pointer = b""
+
+    # ===== Scheduling =====
+    def schedule(self):
+        """طلب إعادة بناء (تُدمج الطلبات المتتالية في بناء واحد)"""
+        if self.render is None:
+            return
+        self.triggers += 1
+        now = time.monotonic()
+        self._last_change = now
+        if self._first_change is None:
+            self._first_change = now
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._debounced_build())
+
+    async def _debounced_build(self):
+        # تغييرات وصلت أثناء build() تبقى في _first_change فتُبنى في دورة أخرى
+        while self._first_change is not None:
+            now = time.monotonic()
+            wait = min(self._last_change + SNAPSHOT_DEBOUNCE_SECONDS,
+                       self._first_change + SNAPSHOT_MAX_DELAY_SECONDS) - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self._first_change = self._last_change = None
+            try:
+                await self.build()
+            except Exception as e:
+                logger.error("Catalog snapshot build failed: %s", e)
+
+    # ===== Build =====
+    async def build(self) -> str:
+        documents = {name: json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                     for name, payload in (await self.render()).items()}
+        digest = hashlib.sha1()
+        for name in sorted(documents):
+            digest.update(name.encode('utf-8'))
+            digest.update(documents[name])
+        version = digest.hexdigest()[:12]
+        if version == self.version:
+            self.skipped += 1
+            return version
+
+        await asyncio.to_thread(_write_version, self.directory / version, documents)
+        pointer = json.dumps({
+            "version": version,
+            "built_at": datetime.utcnow().isoformat(),
+            "files": {name: f"/snapshots/{version}/{name}" for name in sorted(documents)}
+        }).encode('utf-8')
+        await asyncio.to_thread(self._write_pointer, pointer)
+
+        current = {}
+        for name, body in documents.items():
+            current[(name, None)] = body
+            for encoding, suffix in ENCODING_SUFFIXES.items():
+                path = self.directory / version / (name + suffix)
+                if path.exists():
+                    current[(name, encoding)] = await asyncio.to_thread(path.read_bytes)
+        self._current, self._pointer = current, pointer
+        self.version = version
+        self.files = sorted(documents)
+        self.built_at = datetime.utcnow()
+        self.builds += 1
+        await asyncio.to_thread(self._prune)
+        logger.info("Catalog snapshot %s built (%s files)", version, len(documents))
+        return version
+
+    def _write_pointer(self, pointer: bytes):
+        tmp = self.directory / (POINTER_FILE + '.tmp')
+        tmp.write_bytes(pointer)
+        tmp.replace(self.directory / POINTER_FILE)
+
+    def _prune(self):
+        versions = sorted((p for p in self.directory.iterdir() if p.is_dir() and not p.name.endswith('.tmp')),
+                          key=lambda p: p.stat().st_mtime, reverse=True)
+        for old in versions[SNAPSHOT_KEEP_VERSIONS:]:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "files": self.files,
+            "built_at": self.built_at,
+            "builds": self.builds,
+            "skipped": self.skipped,
+            "triggers": self.triggers,
+            "pending": self._task is not None and not self._task.done()
+        }
+
+
+async def _send(send, status: int, body: bytes, headers: list):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-length", str(len(body)).encode('latin-1'))] + headers
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class SnapshotFiles:
+    """
+    تطبيق ASGI يُركَّب على /snapshots: ملفات الإصدارات مع Cache-Control immutable
+    والنسخة المضغوطة المناسبة لـ Accept-Encoding، و current.json بدون cache.
+    """
+
+    def __init__(self, builder: SnapshotBuilder):
+        self.builder = builder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        path = scope.get("path", "")
+        if scope.get("root_path") and path.startswith(scope["root_path"]):
+            path = path[len(scope["root_path"]):]
+        parts = [p for p in path.split('/') if p]
+        json_type = (b"content-type", b"application/json")
+
+        if parts == [POINTER_FILE]:
+            if not self.builder.version:
+                await _send(send, 404, b'{"detail":"Not Found"}', [json_type])
+                return
+            await _send(send, 200, self.builder._pointer, [json_type, (b"cache-control", b"no-cache")])
+            return
+
+        if len(parts) != 2 or parts[0].startswith('.') or parts[1].startswith('.'):
+            await _send(send, 404, b'{"detail":"Not Found"}', [json_type])
+            return
+        version, name = parts
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get("headers", [])}
+        encoding = choose_encoding(headers.get('accept-encoding', ''))
+
+        body = None
+        if version == self.builder.version:
+            body = self.builder._current.get((name, encoding))
+            if body is None:
+                encoding = None
+                body = self.builder._current.get((name, None))
+        else:
+            # إصدار سابق ما زال على القرص
+            directory = self.builder.directory / version
+            candidates = ([(encoding, directory / (name + ENCODING_SUFFIXES[encoding]))] if encoding else [])
+            candidates.append((None, directory / name))
+            for candidate_encoding, file_path in candidates:
+                if file_path.is_file():
+                    encoding = candidate_encoding
+                    body = await asyncio.to_thread(file_path.read_bytes)
+                    break
+
+        if body is None:
+            await _send(send, 404, b'{"detail":"Not Found"}', [json_type])
+            return
+        response_headers = [json_type, (b"cache-control", b"public, max-age=31536000, immutable"),
+                            (b"vary", b"Accept-Encoding")]
+        if encoding:
+            response_headers.append((b"content-encoding", encoding.encode('latin-1')))
+        await _send(send, 200, body, response_headers)
+
+
+# إنشاء instance مشترك
+snapshot_builder = SnapshotBuilder()
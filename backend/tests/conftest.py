@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# الـ modules في backend/ تُستورد بأسمائها المسطحة (from inventory import ...)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
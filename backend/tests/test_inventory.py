@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+
+from inventory import InventoryLedger, InsufficientStock
+from jobs import JobQueue
+
+
+class FakeDB:
+    """قاعدة بيانات وهمية: update_product يكتب القيمة المطلقة بعد تأخير بسيط"""
+
+    def __init__(self, stock: dict):
+        self.stock = dict(stock)
+        self.writes = 0
+        self.down = False
+
+    async def update_product(self, product_id, data):
+        await asyncio.sleep(0.001)
+        if self.down:
+            raise ConnectionError("database unavailable")
+        self.writes += 1
+        self.stock[product_id] = data['stock_quantity']
+        return {'id': product_id, **data}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.mark.parametrize("buyers,stock", [(100, 10), (50, 1), (20, 20), (7, 0)])
+def test_concurrent_reservations_never_oversell(buyers, stock):
+    async def scenario():
+        ledger = InventoryLedger(database=FakeDB({1: stock}))
+        ledger.seed([{'id': 1, 'stock_quantity': stock}])
+
+        async def buy():
+            await asyncio.sleep(0)
+            try:
+                ledger.reserve({1: 1})
+                return True
+            except InsufficientStock:
+                return False
+
+        results = await asyncio.gather(*(buy() for _ in range(buyers)))
+        return ledger, results
+
+    ledger, results = run(scenario())
+    assert sum(results) == min(buyers, stock)
+    assert ledger.available(1) == max(stock - buyers, 0)
+    assert ledger.rejected == buyers - sum(results)
+
+
+def test_concurrent_checkouts_with_flush_write_exact_stock():
+    async def scenario():
+        db = FakeDB({1: 30, 2: 5})
+        ledger = InventoryLedger(database=db)
+        ledger.seed([{'id': 1, 'stock_quantity': 30}, {'id': 2, 'stock_quantity': 5}])
+
+        async def checkout():
+            try:
+                reservation_id = ledger.reserve({1: 2, 2: 1})
+            except InsufficientStock:
+                return False
+            await asyncio.sleep(0.001)  # إنشاء الطلب في قاعدة البيانات
+            ledger.commit(reservation_id)
+            return True
+
+        async def flusher():
+            for _ in range(20):
+                await ledger.flush()
+                await asyncio.sleep(0.0005)
+
+        results, _ = await asyncio.gather(
+            asyncio.gather(*(checkout() for _ in range(40))), flusher()
+        )
+        await ledger.flush()
+        return db, ledger, results
+
+    db, ledger, results = run(scenario())
+    sold = sum(results)
+    assert sold == 5
+    assert db.stock == {1: 30 - 2 * sold, 2: 0}
+    assert ledger.available(1) == 20 and ledger.available(2) == 0
+
+
+def test_release_returns_stock():
+    ledger = InventoryLedger(database=FakeDB({1: 3}))
+    ledger.seed([{'id': 1, 'stock_quantity': 3}])
+    reservation_id = ledger.reserve({1: 3})
+    with pytest.raises(InsufficientStock):
+        ledger.reserve({1: 1})
+    ledger.release(reservation_id)
+    assert ledger.available(1) == 3
+
+
+def test_seed_reconciles_external_stock_edit():
+    async def scenario():
+        db = FakeDB({1: 10})
+        ledger = InventoryLedger(database=db)
+        ledger.seed([{'id': 1, 'stock_quantity': 10}])
+        ledger.commit(ledger.reserve({1: 4}))
+
+        # إعادة تعبئة من لوحة Supabase: 10 -> 50 قبل كتابة الخصم
+        token = ledger.read_token()
+        ledger.seed([{'id': 1, 'stock_quantity': 50}], token)
+        assert ledger.available(1) == 46
+        await ledger.flush()
+        return db, ledger
+
+    db, ledger = run(scenario())
+    assert db.stock[1] == 46
+    assert ledger.reconciled == 1
+
+
+def test_seed_ignores_read_that_overlaps_flush():
+    async def scenario():
+        db = FakeDB({1: 10})
+        ledger = InventoryLedger(database=db)
+        ledger.seed([{'id': 1, 'stock_quantity': 10}])
+        ledger.commit(ledger.reserve({1: 4}))
+
+        # قراءة بدأت قبل flush وأعادت القيمة القديمة 10
+        token = ledger.read_token()
+        await ledger.flush()
+        ledger.seed([{'id': 1, 'stock_quantity': 10}], token)
+        return db, ledger
+
+    db, ledger = run(scenario())
+    assert db.stock[1] == 6
+    assert ledger.available(1) == 6
+    assert ledger.reconciled == 0
+
+
+def test_settle_fails_until_decrement_is_written():
+    async def scenario():
+        db = FakeDB({1: 10})
+        ledger = InventoryLedger(database=db)
+        ledger.seed([{'id': 1, 'stock_quantity': 10}])
+        ledger.commit(ledger.reserve({1: 4}))
+
+        db.down = True
+        with pytest.raises(RuntimeError):
+            await ledger.settle([1])
+        db.down = False
+        await ledger.settle([1])
+        return db
+
+    assert run(scenario()).stock[1] == 6
+
+
+def test_unflushed_decrement_survives_restart(tmp_path):
+    outbox = tmp_path / "outbox.jsonl"
+    db = FakeDB({1: 10})
+
+    def make_queue(ledger):
+        queue = JobQueue(outbox_path=outbox, deadletter_path=tmp_path / "dead.jsonl")
+
+        @queue.handler("stock_committed", recover=lambda p: ledger.consume(dict(p["items"])), retry_forever=True)
+        async def settle(payload):
+            await ledger.settle([pid for pid, _ in payload["items"]])
+
+        return queue
+
+    async def crashed_process():
+        ledger = InventoryLedger(database=db)
+        ledger.seed([{'id': 1, 'stock_quantity': 10}])
+        db.down = True
+        ledger.commit(ledger.reserve({1: 3}))
+        await make_queue(ledger).enqueue("stock_committed", {"order_id": 1, "items": [(1, 3)]})
+        # توقف مفاجئ قبل أي flush ناجح
+
+    async def restarted_process():
+        db.down = False
+        ledger = InventoryLedger(database=db)
+        queue = make_queue(ledger)
+        await queue.start()
+        # المنتج يُقرأ من قاعدة البيانات التي لا تتضمن الخصم
+        ledger.seed([{'id': 1, 'stock_quantity': db.stock[1]}])
+        assert ledger.available(1) == 7
+        await queue.drain(1)
+        await queue.stop()
+        return queue
+
+    run(crashed_process())
+    assert db.stock[1] == 10
+    queue = run(restarted_process())
+    assert db.stock[1] == 7
+    assert queue.stats()["pending_durable"] == 0